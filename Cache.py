@@ -0,0 +1,117 @@
+from collections import OrderedDict
+import numpy as np
+from Functions import Result, get_scenario
+from Store import ResultStore, config_key, model_fingerprint
+
+## Memoization of box model solves: an in-memory LRU bounded in entries and
+## bytes, with an optional on-disk tier (a Store.ResultStore directory)
+
+class SolveCache:
+    """Content-addressed cache around Solvers.run_model and Solvers.solve_linear
+
+    The key is a hash of the model (Store.model_fingerprint: its rate matrix,
+    forcing box and any flux laws or schedules), the initial masses, the scenario's knots, the method and its options, t_span and
+    t_eval, so any change to the inputs misses and identical calls hit
+
+    Parameters
+    ----------
+    maxsize: int
+        Most results kept in memory
+    max_bytes: int
+        Most bytes of result arrays kept in memory
+    store: str or Store.ResultStore
+        Directory for the on-disk tier, None to keep results in memory only
+    """
+    def __init__(self, maxsize = 128, max_bytes = 256 * 2**20, store = None):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.store = ResultStore(store) if isinstance(store, str) else store
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = self.disk_hits = self.misses = 0
+
+    def key(self, model, t_span, scenario = 1, method = 'RK45', t_eval = None, M0 = None, **options):
+        """Key of a solve, raises TypeError if an option cannot be hashed (e.g. a callable)"""
+        sc = get_scenario(scenario)
+        M0 = model.M0 if M0 is None else M0
+        return config_key({'model': model_fingerprint(model), 'M0': np.asarray(M0, dtype = float),
+                           'scenario': [sc.t_yr, sc.e_GtC_yr], 'method': method,
+                           't_span': [float(t_span[0]), float(t_span[1])],
+                           't_eval': None if t_eval is None else np.asarray(t_eval, dtype = float),
+                           'options': options})
+
+    def run(self, model, t_span, scenario = 1, method = 'RK45', t_eval = None, M0 = None, **options):
+        """Solves the box model, or returns the stored result of an identical solve
+
+        Parameters
+        ----------
+        model, t_span, scenario, method, t_eval, M0, **options
+            As for Solvers.run_model; method 'exact' uses Solvers.solve_linear
+            (t_eval required)
+
+        Returns
+        -------
+        result: Functions.Result
+            t, y and the solver counters; the arrays are shared with the
+            cache and read-only
+        """
+        from Solvers import run_model, solve_linear
+
+        try:
+            key = self.key(model, t_span, scenario, method, t_eval, M0, **options)
+        except TypeError: # unhashable option, solve without caching
+            key = None
+        if key is not None:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return Result(self._entries[key])
+            on_disk = not options.get('dense_output') and self.store is not None and self.store.get(key)
+            if on_disk:
+                self.disk_hits += 1
+                res = Result(t = on_disk['t'], y = on_disk['y'], nfev = int(on_disk['nfev']),
+                             status = 0, success = True, sol = None)
+                self._insert(key, res)
+                return Result(res)
+        self.misses += 1
+
+        if method == 'exact':
+            if t_eval is None:
+                raise ValueError("The exact solver needs t_eval")
+            res = Result(t = np.array(t_eval, dtype = float), # copied, the cached arrays are frozen
+                         y = solve_linear(model, t_eval, scenario, M0 = M0, t0 = t_span[0]),
+                         nfev = 0, status = 0, success = True, sol = None)
+        else:
+            res = run_model(model, t_span, scenario, method = method, t_eval = t_eval, M0 = M0, **options)
+        if key is not None and res.success:
+            self._insert(key, res)
+            if self.store is not None and not options.get('dense_output'):
+                self.store.put(key, {'method': method, 't_span': list(t_span)},
+                               t = res.t, y = res.y, nfev = np.array(res.nfev))
+        return Result(res)
+
+    def _insert(self, key, res):
+        for name in ('t', 'y'):
+            res[name].flags.writeable = False
+        self._entries[key] = res
+        self._bytes += res.t.nbytes + res.y.nbytes
+        while self._entries and (len(self._entries) > self.maxsize or self._bytes > self.max_bytes):
+            _, old = self._entries.popitem(last = False)
+            self._bytes -= old.t.nbytes + old.y.nbytes
+
+    def clear(self):
+        """Empties the in-memory tier (the on-disk tier is kept)"""
+        self._entries.clear()
+        self._bytes = 0
+
+    def info(self):
+        """Hit/miss counts and current size of the in-memory tier"""
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'entries': len(self._entries), 'bytes': self._bytes}
+
+## Shared cache for interactive sessions
+default_cache = SolveCache()
+
+def cached_solve(model, t_span, scenario = 1, method = 'RK45', t_eval = None, M0 = None, **options):
+    """SolveCache.run on the shared default_cache"""
+    return default_cache.run(model, t_span, scenario, method, t_eval, M0, **options)
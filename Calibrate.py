@@ -0,0 +1,200 @@
+import csv
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from Functions import BoxModel, Result, get_scenario
+from Initialize import PPM_TO_GTC
+from Sensitivity import flux_edges, flux_label, flux_sensitivity
+
+## Fitting the steady state fluxes of a box model to an observed series of one
+## box's mass (e.g. the atmospheric carbon record). Each fitted flux is
+## F_ij = F0_ij*exp(theta_q), so fluxes stay positive, and the residual
+## Jacobian comes from the forward sensitivities of Sensitivity.py, solved
+## exactly together with the masses, instead of by finite differences.
+
+def read_observations(path, year_col = 0, value_col = 1, units = 'GtC'):
+    """Reads a CSV of observations, one (year, value) per row; a header row and
+    rows with a missing value are skipped, and the rows are sorted by year
+
+    Parameters
+    ----------
+    path: str
+        CSV file
+    year_col, value_col: int or str
+        Column index, or column name if the file has a header
+    units: str
+        'GtC', or 'ppm' for atmospheric CO2 concentrations (converted to GtC)
+
+    Returns
+    -------
+    t: 1D array
+        Years
+    obs: 1D array
+        Observed mass (GtC)
+    """
+    if units not in ('GtC', 'ppm'):
+        raise ValueError("units must be 'GtC' or 'ppm', not '%s'" % units)
+    with open(path, newline = '') as f:
+        rows = [row for row in csv.reader(f) if row and not row[0].lstrip().startswith('#')]
+    if not rows:
+        raise ValueError("No observations in %s" % path)
+    try:
+        float(rows[0][0])
+    except ValueError:
+        header, rows = [h.strip() for h in rows[0]], rows[1:]
+        if not rows:
+            raise ValueError("No observations in %s, only a header" % path)
+        year_col = header.index(year_col) if isinstance(year_col, str) else year_col
+        value_col = header.index(value_col) if isinstance(value_col, str) else value_col
+    t, obs = [], []
+    for row in rows:
+        try:
+            t.append(float(row[year_col])); obs.append(float(row[value_col]))
+        except (ValueError, IndexError):
+            continue
+    if not t:
+        raise ValueError("No observations in %s" % path)
+    t, obs = np.array(t), np.array(obs)
+    order = np.argsort(t, kind = 'stable')
+    return t[order], obs[order] * (PPM_TO_GTC if units == 'ppm' else 1.)
+
+def edges_from_labels(model, labels):
+    """(i, j) flux indices of model fluxes named like 'F21' (see Sensitivity.flux_label)"""
+    names = {flux_label(i, j): (i, j) for i, j in flux_edges(model.F_in)}
+    unknown = [label for label in labels if label not in names]
+    if unknown:
+        raise ValueError("Unknown fluxes %s, the model has %s" % (unknown, sorted(names)))
+    return [names[label] for label in labels]
+
+def _dense(F_in):
+    return np.array(F_in.toarray() if hasattr(F_in, 'toarray') else F_in, dtype = float)
+
+def _fit_one(F_in, M0, forcing_box, edges, scenario, t_obs, obs, sigma, box, t0, theta0, bounds, prior_sd, options):
+    """One least squares fit from theta0, run in a worker process by calibrate"""
+    from scipy.optimize import least_squares
+
+    rows, cols = np.array(edges).T
+    F0 = F_in[rows, cols]
+    last = {}
+
+    def solve(theta):
+        # residuals and Jacobian share one solve of the mass + sensitivity system
+        key = theta.tobytes()
+        if key not in last:
+            F = F_in.copy()
+            F[rows, cols] = F0 * np.exp(theta)
+            model = BoxModel(F, M0, forcing_box = forcing_box)
+            sens = flux_sensitivity(model, t_obs, scenario, edges = edges, box = box, t0 = t0)
+            r = (sens.M[box] - obs) / sigma
+            J = (sens.S * F[rows, cols][:, None]).T / sigma[:, None] # d/dtheta = F*d/dF
+            if prior_sd is not None:
+                r = np.concatenate([r, theta / prior_sd])
+                J = np.vstack([J, np.eye(len(theta)) / prior_sd])
+            last.clear()
+            last[key] = r, J
+        return last[key]
+
+    res = least_squares(lambda th: solve(th)[0], theta0, jac = lambda th: solve(th)[1],
+                        bounds = bounds, **options)
+    return Result(theta = res.x, cost = res.cost, success = res.success, status = res.status,
+                  message = res.message, nfev = res.nfev, njev = res.njev, jac = res.jac)
+
+def calibrate(model, t_obs, obs, fluxes, scenario = 1, sigma = 1., box = None, t0 = None, n_starts = 1,
+              start_sd = 0.5, max_factor = 10., prior_sd = None, n_workers = None, seed = None, **options):
+    """Fits selected fluxes of a box model to observations of one box's mass
+    by gradient based least squares, optionally from several starting points
+    in parallel
+
+    The masses start from the model's steady state at t0, and changed fluxes
+    are generally no longer in balance, so the fitted model can drift even
+    without forcing; fit pairs of opposite fluxes to keep a box balanced
+
+    Parameters
+    ----------
+    model: Functions.BoxModel
+        Box model with the first guess fluxes F_in and the masses M0
+    t_obs: 1D array
+        Years of the observations, non-decreasing and not before t0
+    obs: 1D array
+        Observed mass of the box (GtC)
+    fluxes: list of str or (i, j) pairs
+        Fluxes to fit, by label ('F21' is the flux from box 2 to box 1) or index
+    scenario: int, str or Functions.EmissionsScenario
+        The forcing scenario to use, see Functions.get_scenario
+    sigma: float or 1D array
+        Observation uncertainty (GtC), weights the residuals
+    box: int
+        Observed box, defaults to the forcing (atmosphere) box
+    t0: float
+        Year of the steady state initial masses, defaults to t_obs[0]
+    n_starts: int
+        Number of fits; the first starts from the model's fluxes, the others
+        from random multiples of them (lognormal, start_sd)
+    start_sd: float
+        Log standard deviation of the random starts
+    max_factor: float
+        Fitted fluxes are kept within [F0/max_factor, F0*max_factor]
+    prior_sd: float
+        Log standard deviation of a Gaussian prior around the model's
+        fluxes, added as extra residuals to regularize poorly constrained
+        fluxes; None for no prior
+    n_workers: int
+        Worker processes for the starts, defaults to the CPU count
+    seed: int
+        Seed of the random starts
+    **options
+        Passed on to scipy.optimize.least_squares (xtol, max_nfev, ...)
+
+    Returns
+    -------
+    result: Result
+        edges and labels of the fitted fluxes; fluxes: dict label -> fitted
+        flux (GtC/yr); factor: fitted/initial flux ratios; log_sd: standard
+        errors of log(flux) from the Jacobian; F_in: the fitted flux array;
+        model: a BoxModel with the fitted fluxes; cost, success, message,
+        nfev, njev of the best fit and costs: the final cost of every start
+    """
+    if not getattr(model, 'is_linear', True):
+        raise ValueError("calibrate needs a model with a constant rate matrix")
+    t_obs = np.asarray(t_obs, dtype = float)
+    obs = np.asarray(obs, dtype = float)
+    if t_obs.shape != obs.shape or t_obs.ndim != 1:
+        raise ValueError("t_obs and obs must be 1D arrays of the same length")
+    if np.any(np.diff(t_obs) < 0):
+        raise ValueError("t_obs must be non-decreasing")
+    edges = edges_from_labels(model, fluxes) if all(isinstance(f, str) for f in fluxes) \
+        else [tuple(int(x) for x in f) for f in fluxes]
+    box = model.forcing_box if box is None else box
+    t0 = t_obs[0] if t0 is None else float(t0)
+    sigma = np.broadcast_to(np.asarray(sigma, dtype = float), obs.shape)
+    F_in = _dense(model.F_in)
+    rows, cols = np.array(edges).T
+    if np.any(F_in[rows, cols] <= 0):
+        raise ValueError("Only non-zero fluxes can be fitted")
+
+    p = len(edges)
+    rng = np.random.default_rng(seed)
+    lim = np.log(max_factor)
+    starts = np.vstack([np.zeros(p), np.clip(start_sd * rng.standard_normal((n_starts - 1, p)), -lim, lim)])
+    common = (F_in, model.M0, model.forcing_box, edges, get_scenario(scenario), t_obs, obs, sigma, box, t0)
+    jobs = [common + (theta0, (-lim, lim), prior_sd, options) for theta0 in starts]
+
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if n_workers <= 1 or len(jobs) <= 1:
+        fits = [_fit_one(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers = min(n_workers, len(jobs))) as pool:
+            fits = list(pool.map(_fit_one, *zip(*jobs)))
+
+    best = min(fits, key = lambda fit: fit.cost)
+    F = F_in.copy()
+    F[rows, cols] = F_in[rows, cols] * np.exp(best.theta)
+    J = best.jac
+    log_sd = np.sqrt(np.diag(np.linalg.pinv(J.T @ J)))
+    labels = [flux_label(i, j) for i, j in edges]
+    return Result(edges = edges, labels = labels, fluxes = dict(zip(labels, F[rows, cols].tolist())),
+                  factor = np.exp(best.theta), log_sd = log_sd, F_in = F,
+                  model = BoxModel(F, model.M0, forcing_box = model.forcing_box, name = model.name),
+                  cost = best.cost, success = best.success, message = best.message,
+                  nfev = best.nfev, njev = best.njev, costs = [fit.cost for fit in fits])
@@ -0,0 +1,111 @@
+import numpy as np
+from Functions import Result
+
+## Time step convergence of forward Euler for the two test problems of
+## odeintex1.py and odeintex2.py. Forward Euler on a linear ODE is a power of
+## one amplification factor, so the solution after n steps has a closed form
+## and a whole sweep of dt values is evaluated at once, without a time loop:
+##   decay:   y' = -Lambda*y                y_n = (1 - Lambda*dt)**n * y0
+##   coupled: y' = Lambda*yy, yy' = -Lambda*y
+##            with w = y + i*yy,            w_n = (1 - i*Lambda*dt)**n * w0
+##            i.e. a rotation by atan(Lambda*dt) and growth by sqrt(1 + (Lambda*dt)**2) per step
+
+systems = ('decay', 'coupled')
+
+def _check_system(system):
+    if system not in systems:
+        raise ValueError("Unknown system '%s', expected one of %s" % (system, systems))
+
+def euler_solution(system, dt, n, Lambda = 0.75, y0 = 1.):
+    """Forward Euler solution after n steps of size dt, from the closed form
+
+    Parameters
+    ----------
+    system: str
+        'decay' or 'coupled'
+    dt: float or array
+        Time step(s)
+    n: int or array
+        Number of steps, broadcast against dt
+    Lambda: float
+        Decay constant / angular frequency
+    y0: float
+        Initial value of y (and of yy for the coupled system)
+
+    Returns
+    -------
+    y: array
+        Shape of dt and n broadcast together; for 'coupled' a leading axis of
+        length 2 holds y and yy
+    """
+    _check_system(system)
+    dt, n = np.asarray(dt, dtype = float), np.asarray(n)
+    if system == 'decay':
+        return y0*np.power(1 - Lambda*dt, n)
+    # growth r**n evaluated as exp(n*log r), rotation by n*theta
+    growth = np.exp(0.5*n*np.log1p((Lambda*dt)**2))
+    w = y0*(1 + 1j)*growth*np.exp(-1j*n*np.arctan(Lambda*dt))
+    return np.stack([w.real, w.imag])
+
+def analytic_solution(system, t, Lambda = 0.75, y0 = 1.):
+    """Exact solution at time(s) t, same layout as euler_solution"""
+    _check_system(system)
+    t = np.asarray(t, dtype = float)
+    if system == 'decay':
+        return y0*np.exp(-Lambda*t)
+    c, s = np.cos(Lambda*t), np.sin(Lambda*t)
+    return y0*np.stack([c + s, c - s])
+
+def euler_trajectory(system, dt, tmax, Lambda = 0.75, y0 = 1., t0 = 0.):
+    """Forward Euler trajectory on steps of dt from t0, as marched in
+    odeintex1.py/odeintex2.py, without the per-step loop
+
+    Returns
+    -------
+    t: 1D array
+        round(tmax/dt)+1 times
+    y: 1D array, or 2 x len(t) array (y and yy) for 'coupled'
+    """
+    n = np.arange(int(np.round(tmax/dt)) + 1)
+    return t0 + n*dt, euler_solution(system, dt, n, Lambda, y0)
+
+def dt_sweep(dts, system = 'decay', Lambda = 0.75, y0 = 1., tmax = 10., n_eval = 201):
+    """Error of forward Euler against the analytic solution for many time steps
+
+    The error of each dt is measured at the step nearest to each of n_eval
+    times spread over [0, tmax] (the last one at round(tmax/dt) steps), all
+    dt at once as a (len(dts), n_eval) array
+
+    Parameters
+    ----------
+    dts: 1D array
+        Time steps
+    system: str
+        'decay' or 'coupled'
+    Lambda, y0: float
+        As for euler_solution
+    tmax: float
+        Integration time
+    n_eval: int
+        Times the error is checked at
+
+    Returns
+    -------
+    result: Result
+        dt (sorted, decreasing), max_err (max abs error over the check
+        times and components), final_err (abs error at tmax), order (local
+        slope of log(max_err) against log(dt), NaN for the first dt) and
+        stable (whether the amplification factor is at most 1 in magnitude)
+    """
+    dt = np.sort(np.asarray(dts, dtype = float).ravel())[::-1]
+    if np.any(dt <= 0):
+        raise ValueError("Time steps must be positive")
+    n = np.round(np.linspace(0., tmax, n_eval)/dt[:, None]) # (n_dt, n_eval) step counts
+    err = np.abs(euler_solution(system, dt[:, None], n, Lambda, y0) - analytic_solution(system, n*dt[:, None], Lambda, y0))
+    if system == 'coupled':
+        err = err.max(axis = 0)
+    max_err = err.max(axis = 1)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        order = np.append(np.nan, np.diff(np.log(max_err))/np.diff(np.log(dt)))
+    factor = np.abs(1 - Lambda*dt) if system == 'decay' else np.hypot(1., Lambda*dt)
+    return Result(dt = dt, max_err = max_err, final_err = err[:, -1], order = order, stable = factor <= 1.)
@@ -0,0 +1,152 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from Functions import Result, Find_k, get_scenario
+from Solvers import _solve_affine
+
+## Monte Carlo propagation of flux uncertainty through the linear box models
+
+def sample_fluxes(F_in, n, rel_sd = 0.1, rng = None):
+    """Samples flux-in arrays with lognormal multiplicative errors on every
+    non-zero flux (the median of each sample is the given flux)
+
+    Parameters
+    ----------
+    F_in: NxN array
+        Array with flux-in values, as in Initialize.py
+    n: int
+        Number of samples
+    rel_sd: float or NxN array
+        Relative (log) standard deviation of each flux
+    rng: numpy Generator
+        Random number generator, defaults to np.random.default_rng()
+
+    Returns
+    -------
+    F: nxNxN array
+        Sampled flux-in arrays
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    F_in = np.asarray(F_in, dtype = float)
+    z = rng.standard_normal((n,) + F_in.shape)
+    return F_in * np.exp(np.asarray(rel_sd) * z)
+
+def _bin_counts(M, lo, width, n_bins):
+    """Histogram counts of a batch of trajectories M (n, n_t, n_boxes) on the
+    per-(time, box) bins starting at lo, out of range values go to the end bins.
+    The counts are at most the batch size, so they are stored in the smallest
+    unsigned type that holds it (uint16 up to 65535 members)"""
+    idx = np.clip(((M - lo) / width).astype(np.int64), 0, n_bins - 1)
+    flat = (np.arange(lo.size).reshape(lo.shape) * n_bins + idx).ravel()
+    dtype = np.uint16 if len(M) <= np.iinfo(np.uint16).max else np.uint32
+    return np.bincount(flat, minlength = lo.size * n_bins).astype(dtype).reshape(lo.shape + (n_bins,))
+
+def _run_batch(F_in, M0, forcing_box, n, rel_sd, seed, scenario, t_eval, t0, lo, width, n_bins):
+    """Samples and solves one batch of ensemble members and reduces it to
+    histogram counts per (time, box), so only the counts go back to the parent"""
+    F = sample_fluxes(F_in, n, rel_sd, np.random.default_rng(seed))
+    k = Find_k(F, M0)
+    b = np.zeros(len(M0))
+    b[forcing_box] = 1.
+    M = _solve_affine(k, b, M0, t0, t_eval, scenario.t_yr, scenario.e_GtC_yr) # (n, n_t, n_boxes)
+    return _bin_counts(M, lo, width, n_bins), M.sum(axis = 0), M.min(axis = 0), M.max(axis = 0)
+
+def run_ensemble(model, t_eval, n_members, scenario = 1, rel_sd = 0.1, quantiles = (5, 50, 95),
+                 batch_size = 1000, n_workers = None, n_bins = 200, seed = None):
+    """Propagates flux uncertainty through the box model: samples flux arrays,
+    derives k with Find_k and solves each batch of members at once with the
+    exact linear solver, spreading the batches over a process pool. Each batch
+    is reduced to per-(time, box) histograms, so memory does not grow with
+    the ensemble size; quantiles are interpolated linearly within the bin
+    they fall in. With the defaults a batch's counts are about 1/20 of the
+    size of its trajectories
+
+    Parameters
+    ----------
+    model: Functions.BoxModel
+        Box model giving the central fluxes F_in, initial masses and forcing box
+    t_eval: 1D array
+        Non-decreasing times (yr) to return the quantiles at, starting at M0
+    n_members: int
+        Ensemble size
+    scenario: int, str or Functions.EmissionsScenario
+        The forcing scenario to use, see Functions.get_scenario
+    rel_sd: float or NxN array
+        Relative (log) standard deviation of each flux
+    quantiles: sequence of floats
+        Percentiles to return
+    batch_size: int
+        Members solved together in one vectorized call
+    n_workers: int
+        Worker processes, defaults to the CPU count; 1 runs in this process
+    n_bins: int
+        Histogram bins per (time, box); the bin range is set from a pilot
+        batch with 50% margin, values outside it land in the end bins. The
+        counts sent back per batch take 2*n_t*n_boxes*n_bins bytes
+    seed: int
+        Seed for reproducible ensembles
+
+    Returns
+    -------
+    result: Result
+        t: the output times; quantiles: dict of percentile -> (n_boxes, n_t)
+        arrays; mean, min, max: (n_boxes, n_t) arrays; n_members
+    """
+    if not getattr(model, 'is_linear', True):
+        raise ValueError("run_ensemble needs a model with a constant rate matrix")
+    if n_members < 1 or batch_size < 1:
+        raise ValueError("n_members and batch_size must be at least 1, got %d and %d" % (n_members, batch_size))
+    t_eval = np.asarray(t_eval, dtype = float)
+    scenario = get_scenario(scenario)
+    t0 = t_eval[0]
+    n_batches = -(-n_members // batch_size)
+    sizes = [batch_size] * (n_batches - 1) + [n_members - batch_size * (n_batches - 1)]
+    seeds = np.random.SeedSequence(seed).spawn(n_batches)
+    F_in = model.F_in.toarray() if hasattr(model.F_in, 'toarray') else model.F_in # sampled densely
+    common = (F_in, model.M0, model.forcing_box)
+
+    # the pilot batch fixes the histogram range and is counted as part of the ensemble
+    F = sample_fluxes(F_in, sizes[0], rel_sd, np.random.default_rng(seeds[0]))
+    b = np.zeros(model.n_boxes)
+    b[model.forcing_box] = 1.
+    pilot = _solve_affine(Find_k(F, model.M0), b, model.M0, t0, t_eval, scenario.t_yr, scenario.e_GtC_yr)
+    p_min, p_max = pilot.min(axis = 0), pilot.max(axis = 0)
+    span = np.maximum(p_max - p_min, 1e-9 * np.maximum(np.abs(p_max), 1.))
+    lo = p_min - 0.5 * span
+    width = 2. * span / n_bins
+    counts = _bin_counts(pilot, lo, width, n_bins).astype(np.int64) # summed over batches in int64
+    total, v_min, v_max = pilot.sum(axis = 0), p_min, p_max
+    del pilot, F
+
+    jobs = [common + (n, rel_sd, s, scenario, t_eval, t0, lo, width, n_bins)
+            for n, s in zip(sizes[1:], seeds[1:])]
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if n_workers <= 1 or len(jobs) <= 1:
+        results = (_run_batch(*job) for job in jobs)
+    else:
+        pool = ProcessPoolExecutor(max_workers = min(n_workers, len(jobs)))
+        results = (f.result() for f in as_completed([pool.submit(_run_batch, *job) for job in jobs]))
+    try:
+        for c, s, mn, mx in results: # streamed, each batch is folded in as it finishes
+            counts += c
+            total += s
+            np.minimum(v_min, mn, out = v_min)
+            np.maximum(v_max, mx, out = v_max)
+    finally:
+        if n_workers > 1 and len(jobs) > 1:
+            pool.shutdown()
+
+    # quantiles by linear interpolation within the bin where the CDF crosses them
+    cdf = np.cumsum(counts, axis = -1)
+    out = {}
+    for q in quantiles:
+        target = q / 100. * n_members
+        ib = np.minimum((cdf < target).sum(axis = -1), n_bins - 1)
+        below = np.where(ib > 0, np.take_along_axis(cdf, np.maximum(ib - 1, 0)[..., None], -1)[..., 0], 0)
+        in_bin = np.take_along_axis(counts, ib[..., None], -1)[..., 0]
+        frac = np.clip((target - below) / np.maximum(in_bin, 1), 0., 1.)
+        out[q] = np.clip(lo + (ib + frac) * width, v_min, v_max).T
+
+    return Result(t = t_eval, quantiles = out, mean = (total / n_members).T,
+                  min = v_min.T, max = v_max.T, n_members = n_members)
@@ -0,0 +1,146 @@
+import numpy as np
+from Functions import Find_k, get_scenario
+
+## Nonlinear flux laws for the box models. Every law scales the steady state
+## flux F0 of an edge with the mass ratio r = M_src/M0_src of its source box,
+## so the initial masses stay a steady state whatever laws are chosen:
+##   linear:        F = F0*r                  (k*M, as in Find_k)
+##   power:         F = F0*r**b               (the a*y**b form of RKex.oneode)
+##   revelle:       F = F0*r**xi              (ocean buffer factor, surface water -> atmosphere)
+##   fertilization: F = F0*(1 + beta*ln(r))   (CO2 fertilization, atmosphere -> biota)
+
+## default parameter of each law
+flux_laws = {'linear': 1.,
+             'power': 1.,
+             'revelle': 9.,       # buffer factor xi
+             'fertilization': 0.4} # beta
+
+class NonlinearBoxModel:
+    """Box model with a pluggable flux law on each edge. The linear edges are
+    precompiled into a rate matrix and the nonlinear ones are evaluated as
+    array operations over their edge list instead of per-edge Python
+
+    Parameters
+    ----------
+    F_in: NxN array
+        Array with steady state flux-in values, F_in[i, j] is the flux from box j to box i
+    M0: N-length vector
+        Initial (steady state) values of mass for each box
+    laws: dict
+        Maps (i, j) edges to a law name or a (name, parameter) tuple, e.g.
+        {(0, 1): 'revelle', (4, 0): ('fertilization', 0.3)}; edges not listed are linear
+    forcing_box: int
+        Index of the box the emissions forcing is added to (atmosphere)
+    name: str
+        Name of the configuration
+    """
+    is_linear = False
+
+    def __init__(self, F_in, M0, laws = None, forcing_box = 0, name = None):
+        self.F_in = np.array(F_in, dtype = float)
+        self.M0 = np.array(M0, dtype = float)
+        self.n_boxes = len(self.M0)
+        self.forcing_box = forcing_box
+        self.name = name
+        laws = {} if laws is None else dict(laws)
+
+        dst, src = np.nonzero(self.F_in)
+        for (i, j) in laws:
+            if self.F_in[i, j] == 0:
+                raise ValueError("No flux from box %d to box %d to apply a flux law to" % (j, i))
+        kinds, params = [], []
+        for i, j in zip(dst, src):
+            law = laws.get((i, j), 'linear')
+            kind, param = (law, None) if isinstance(law, str) else law
+            if kind not in flux_laws:
+                raise ValueError("Unknown flux law '%s', expected one of %s" % (kind, sorted(flux_laws)))
+            kinds.append(kind)
+            params.append(flux_laws[kind] if param is None else param)
+        kinds = np.array(kinds)
+
+        self.src, self.dst = src, dst
+        self.F0 = self.F_in[dst, src]
+        self.param = np.array(params, dtype = float)
+        self.laws = dict(zip(zip(dst.tolist(), src.tolist()), kinds.tolist()))
+
+        # linear edges are folded into a constant rate matrix as in Find_k, the
+        # others are grouped by the form of their law: r**p and 1 + p*ln(r)
+        lin = kinds == 'linear'
+        F_lin = np.zeros_like(self.F_in)
+        F_lin[dst[lin], src[lin]] = self.F0[lin]
+        self.k_lin = Find_k(F_lin, self.M0)
+        self._pow = np.flatnonzero((kinds == 'power') | (kinds == 'revelle'))
+        self._log = np.flatnonzero(kinds == 'fertilization')
+        self._nl = np.concatenate([self._pow, self._log])
+        # incidence matrix of the nonlinear edges, their contribution to dM/dt is D_nl @ flux
+        self.D_nl = np.zeros((self.n_boxes, len(self._nl)))
+        self.D_nl[dst[self._nl], np.arange(len(self._nl))] += 1.
+        self.D_nl[src[self._nl], np.arange(len(self._nl))] -= 1.
+        # per-group constants gathered once for the RHS
+        pw, lg = self._pow, self._log
+        self._src_pw, self._M0_pw, self._F0_pw, self._p_pw = src[pw], self.M0[src[pw]], self.F0[pw], self.param[pw]
+        self._src_lg, self._M0_lg, self._F0_lg, self._p_lg = src[lg], self.M0[src[lg]], self.F0[lg], self.param[lg]
+
+    def _nonlinear_fluxes(self, M):
+        """Fluxes along the nonlinear edges (in the order of self._nl) for masses M"""
+        if M.ndim == 1:
+            r_pw = M[self._src_pw] / self._M0_pw
+            r_lg = M[self._src_lg] / self._M0_lg
+            return np.concatenate([self._F0_pw * r_pw**self._p_pw,
+                                   self._F0_lg * (1. + self._p_lg*np.log(r_lg))])
+        r_pw = M[self._src_pw] / self._M0_pw[:, None]
+        r_lg = M[self._src_lg] / self._M0_lg[:, None]
+        return np.concatenate([self._F0_pw[:, None] * r_pw**self._p_pw[:, None],
+                               self._F0_lg[:, None] * (1. + self._p_lg[:, None]*np.log(r_lg))])
+
+    def fluxes(self, M):
+        """Flux along every edge for masses M (N-length or NxK array)
+
+        Returns
+        -------
+        F: E-length array (or ExK array)
+            Fluxes in the order of self.src/self.dst
+        """
+        M = np.asarray(M, dtype = float)
+        shape = (-1,) + (1,)*(M.ndim - 1)
+        F = self.F0.reshape(shape) * M[self.src] / self.M0[self.src].reshape(shape)
+        F[self._nl] = self._nonlinear_fluxes(M)
+        return F
+
+    def rhs(self, t, M, a = 0):
+        """Right hand side of the mass flux ODEs, same interface as BoxModel.rhs
+
+        Parameters
+        ----------
+        t: float
+            Time (yr)
+        M: N-length array, or NxK array when called with vectorized = True
+            Mass in each box
+        a: int, str or EmissionsScenario
+            The forcing scenario to use, see Functions.get_scenario
+
+        Returns
+        -------
+        dMdt: N-length array (or NxK array)
+            Mass flux for one timestep
+        """
+        M = np.asarray(M)
+        dMdt = self.k_lin @ M
+        if len(self._nl):
+            dMdt += self.D_nl @ self._nonlinear_fluxes(M)
+        scenario = get_scenario(a)
+        if not scenario.is_zero:
+            dMdt[self.forcing_box] += scenario(t)
+        return dMdt
+
+    def jac(self, t, M, a = 0):
+        """Analytic Jacobian dF/dM at masses M, for the implicit solve_ivp methods"""
+        M = np.asarray(M, dtype = float).reshape(self.n_boxes, -1)[:, 0]
+        J = self.k_lin.copy()
+        r_pw = M[self._src_pw] / self._M0_pw
+        r_lg = M[self._src_lg] / self._M0_lg
+        dF = np.concatenate([self._p_pw * r_pw**(self._p_pw - 1.), self._p_lg / r_lg])
+        dF *= self.F0[self._nl] / self.M0[self.src[self._nl]]
+        np.add.at(J, (self.dst[self._nl], self.src[self._nl]), dF)
+        np.add.at(J, (self.src[self._nl], self.src[self._nl]), -dF)
+        return J
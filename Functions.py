@@ -1,23 +1,39 @@
+import bisect
+import contextlib
+import functools
 import numpy as np
-import matplotlib.pyplot as plt
-from Initialize import *
+from Initialize import * # only cheap array definitions; models are built lazily by get_model
+
+class Result(dict):
+    """Dictionary of solver outputs with attribute access (result.t, result.y),
+    like scipy's OdeResult but without importing scipy"""
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    __setattr__ = dict.__setitem__
+    __delattr__ = dict.__delitem__
+
+    def __dir__(self):
+        return list(self.keys())
 
 ## Defining functions, 
-def emissions(yr, opt = 100):
-    """Function defining A2 emission scenario over the interval 1990-2100
-    extended to pre-industrial (assuming linear increase from 0 in 1850 to
-    1900) and assuming full cessation of CO_2 input at 2101
-    For additional information see http://www.grida.no/climate/ipcc/emission
+def emissions_table(opt = 100):
+    """Knots of the piecewise linear emission scenarios used by emissions
 
     Parameters
     ----------
-    yr: 1D array
-        Year range for emission scenario
+    opt: int
+        Emission scenario option, see emissions
 
     Returns
     -------
-    e: double
-        A2 emissions in a given year
+    t_yr: 1D array
+        Years of the knots
+    e_GtC_yr: 1D array
+        Emissions at each knot (GtC/yr)
 
     """
     t_yr = np.array([0, 1850, 1990, 2000, 2010, 2020, 2030, 2040, 2050, 2060, 2070, 2080, 2090, 2100, 2110, 2120, 10000])
@@ -39,7 +55,152 @@ def emissions(yr, opt = 100):
     elif opt == 5: # alternate emissions scenario IPCC A1F1 (fossil fuel intensive)
         e_GtC_yr = np.array([0, 0,  5.99, 6.9, 8.65, 11.19, 14.61, 18.66, 23.1, 25.14, 27.12, 29.04, 29.64, 30.32, 0, 0, 0])
 
-    e = np.interp(yr, t_yr, e_GtC_yr)
+    return t_yr, e_GtC_yr
+
+class EmissionsScenario:
+    """Piecewise linear emission scenario with its knot arrays built once
+
+    Scalar times are looked up in O(1) on a uniform year grid with precomputed
+    segment slopes (the knots all fall on multiples of the grid step, so this
+    is exact); arrays of times use np.interp on the knots
+
+    Parameters
+    ----------
+    name: str
+        Name of the scenario, e.g. 'A2'
+    t_yr: 1D array
+        Increasing years of the knots
+    e_GtC_yr: 1D array
+        Emissions at each knot (GtC/yr)
+    max_grid: int
+        Largest uniform grid to build; scenarios with finer or irregular knots
+        fall back to a binary search over the knots
+    """
+    def __init__(self, name, t_yr, e_GtC_yr, max_grid = 100000):
+        self.name = name
+        self.t_yr = np.array(t_yr, dtype = float)
+        self.e_GtC_yr = np.array(e_GtC_yr, dtype = float)
+        if self.t_yr.shape != self.e_GtC_yr.shape or np.any(np.diff(self.t_yr) <= 0):
+            raise ValueError("Scenario '%s' needs increasing knot years matching its emissions" % name)
+        self.t_yr.flags.writeable = False
+        self.e_GtC_yr.flags.writeable = False
+        self.is_zero = not np.any(self.e_GtC_yr)
+
+        self._t_first, self._t_last = self.t_yr[0], self.t_yr[-1]
+        self._e_first, self._e_last = self.e_GtC_yr[0], self.e_GtC_yr[-1]
+        self._step = None
+        if np.all(self.t_yr == np.round(self.t_yr)):
+            step = float(np.gcd.reduce(np.diff(self.t_yr).astype(np.int64)))
+            n = int((self._t_last - self._t_first) / step)
+            if n <= max_grid:
+                grid = self._t_first + step*np.arange(n+1)
+                values = np.interp(grid, self.t_yr, self.e_GtC_yr)
+                self._step, self._n = step, n
+                self._values = values[:-1].tolist() # python lists index faster than arrays for scalars
+                self._slopes = (np.diff(values)/step).tolist()
+        if self._step is None:
+            self._knots = self.t_yr.tolist()
+            self._values = self.e_GtC_yr.tolist()
+            self._slopes = (np.diff(self.e_GtC_yr)/np.diff(self.t_yr)).tolist()
+
+    def __repr__(self):
+        return "EmissionsScenario(%r)" % self.name
+
+    def __call__(self, yr):
+        """Emissions in the given year(s), same as np.interp over the knots
+
+        Parameters
+        ----------
+        yr: float or array
+            Year(s) to evaluate the scenario at
+
+        Returns
+        -------
+        e: float or array
+            Emissions (GtC/yr)
+        """
+        if isinstance(yr, (float, int)) or np.ndim(yr) == 0:
+            return self.scalar(float(yr))
+        return np.interp(yr, self.t_yr, self.e_GtC_yr)
+
+    def scalar(self, yr):
+        """Emissions in a single year (float), the fast path used in RHS calls"""
+        if yr <= self._t_first:
+            return self._e_first
+        if yr >= self._t_last:
+            return self._e_last
+        if self._step is not None:
+            i = int((yr - self._t_first) / self._step)
+            if i >= self._n:
+                i = self._n - 1
+            return self._values[i] + self._slopes[i]*(yr - self._t_first - i*self._step)
+        i = bisect.bisect_right(self._knots, yr) - 1
+        return self._values[i] + self._slopes[i]*(yr - self._knots[i])
+
+## Registry of named emission scenarios, built once at import
+scenarios = {}
+
+def register_scenario(scenario):
+    """Adds an EmissionsScenario to the registry under its name and returns it"""
+    scenarios[scenario.name] = scenario
+    return scenario
+
+register_scenario(EmissionsScenario('none', [0, 10000], [0, 0]))
+for _name, _opt in [('A2', 100), ('A2_hold2000', 0), ('sine', 1), ('decay', 2),
+                    ('A1T', 3), ('cos', 4), ('A1FI', 5)]:
+    register_scenario(EmissionsScenario(_name, *emissions_table(_opt)))
+_scenario_opts = {0: scenarios['A2_hold2000'], 1: scenarios['sine'], 2: scenarios['decay'],
+                  3: scenarios['A1T'], 4: scenarios['cos'], 5: scenarios['A1FI']}
+
+## Forcing scenario codes used by MassFlux/BoxModel, mapped to registry names
+scenario_codes = {0: 'none',        # no forcing, steady state
+                  1: 'A2',          # IPCC A2 emissions
+                  2: 'A2_hold2000', # A2 modified to keep 2000 emissions beyond 2110
+                  3: 'sine',        # sine periodic forcing
+                  4: 'decay',       # exponential periodic forcing (decay)
+                  5: 'A1T',         # IPCC A1T
+                  6: 'cos',         # cos periodic forcing
+                  7: 'A1FI'}        # IPCC A1FI
+
+def get_scenario(key):
+    """Looks up an emission scenario
+
+    Parameters
+    ----------
+    key: EmissionsScenario, str or int
+        A scenario, its registry name, or a MassFlux forcing code (0-7)
+
+    Returns
+    -------
+    scenario: EmissionsScenario
+    """
+    if isinstance(key, EmissionsScenario):
+        return key
+    name = scenario_codes.get(key, key) if isinstance(key, (int, np.integer)) else key
+    try:
+        return scenarios[name]
+    except (KeyError, TypeError):
+        raise ValueError("Unknown emission scenario %r, expected one of %s or codes %s"
+                         % (key, sorted(scenarios), sorted(scenario_codes))) from None
+
+def emissions(yr, opt = 100):
+    """Function defining A2 emission scenario over the interval 1990-2100
+    extended to pre-industrial (assuming linear increase from 0 in 1850 to
+    1900) and assuming full cessation of CO_2 input at 2101
+    For additional information see http://www.grida.no/climate/ipcc/emission
+
+    Parameters
+    ----------
+    yr: 1D array
+        Year range for emission scenario
+
+    Returns
+    -------
+    e: double
+        A2 emissions in a given year
+
+    """
+    e = _scenario_opts.get(opt, scenarios['A2'])(yr) # knot arrays are cached in the registry
 
     return e
 
@@ -49,7 +210,7 @@ def Find_k(F_in, M):
 
     Parameters
     ----------
-    F_in: NxM array
+    F_in: NxM array, or SxNxM array for a batch of S flux arrays
         Array with flux-in values
     F_out: NxM array
         Array with flux-out values, positive flux values
@@ -58,15 +219,216 @@ def Find_k(F_in, M):
 
     Returns
     -------
-    k: NxM array
+    k: NxM array (or SxNxM array)
         Array of k constant values to solve M-box model. k*M gives M ODEs to 
         solve M box model problem
     """
     k_in = F_in/M
-    k_out = sum(k_in) # column-wise sum of k values 
-    k = k_in - k_out*np.diag(np.ones(len(F_in)))
+    k_out = k_in.sum(axis = -2) # column-wise sum of k values 
+    k = k_in - k_out[..., None, :]*np.diag(np.ones(F_in.shape[-1]))
+    return k
+
+def _find_k_sparse(F_in, M):
+    """Find_k for a scipy.sparse flux-in matrix, without building dense arrays
+
+    Returns
+    -------
+    k: NxN CSR matrix
+    """
+    from scipy.sparse import diags
+    k_in = F_in @ diags(1./M)
+    k_out = np.asarray(k_in.sum(axis = 0)).ravel() # column-wise sum of k values
+    k = (k_in - diags(k_out)).tocsr()
+    k.sum_duplicates() # canonical format, so later operations never sort the frozen data in place
     return k
 
+class BoxModel:
+    """Linear box model of the carbon cycle, dM/dt = k*M + forcing, with the
+    rate matrix k computed once from the steady state fluxes and frozen
+
+    Parameters
+    ----------
+    F_in: NxN array or scipy.sparse matrix
+        Array with flux-in values, F_in[i, j] is the flux from box j to box i;
+        a sparse F_in gives a sparse (CSR) rate matrix, for large networks
+    M0: N-length vector
+        Initial (steady state) values of mass for each box
+    forcing_box: int
+        Index of the box the emissions forcing is added to (atmosphere)
+    name: str
+        Name of the configuration, e.g. '4box' or '9box'
+    box_names: list of str
+        Names of the boxes, defaults to 'box1', 'box2', ...
+    """
+    is_linear = True
+
+    def __init__(self, F_in, M0, forcing_box = 0, name = None, box_names = None):
+        self.M0 = np.array(M0, dtype = float)
+        if hasattr(F_in, 'tocsr'): # scipy.sparse, never densified
+            self.F_in = F_in.tocsr().astype(float)
+            self.k = _find_k_sparse(self.F_in, self.M0)
+            self.k.data.flags.writeable = False
+        else:
+            self.F_in = np.array(F_in, dtype = float)
+            self.k = Find_k(self.F_in, self.M0)
+            self.k.flags.writeable = False # frozen, rhs relies on it never changing
+        self.n_boxes = len(self.M0)
+        self.forcing_box = forcing_box
+        self.name = name
+        self.box_names = ['box%d' % (i+1) for i in range(self.n_boxes)] if box_names is None else list(box_names)
+        if len(self.box_names) != self.n_boxes:
+            raise ValueError("Expected %d box names, got %d" % (self.n_boxes, len(self.box_names)))
+
+    @property
+    def is_sparse(self):
+        """Whether the rate matrix is stored as a scipy.sparse CSR matrix"""
+        return hasattr(self.k, 'tocsr')
+
+    def dense_k(self):
+        """The rate matrix as a dense array"""
+        return self.k.toarray() if self.is_sparse else self.k
+
+    @classmethod
+    def from_config(cls, name, forcing_box = 0):
+        """Builds the model for one of the topologies in Initialize.box_models
+
+        Parameters
+        ----------
+        name: str
+            Configuration name, '4box' or '9box'
+        forcing_box: int
+            Index of the box the emissions forcing is added to
+
+        Returns
+        -------
+        model: BoxModel
+            Model with the precompiled rate matrix for that configuration
+        """
+        if name not in box_models:
+            raise ValueError("Unknown box model '%s', expected one of %s" % (name, sorted(box_models)))
+        F_in, M0 = box_models[name]
+        return cls(F_in, M0, forcing_box = forcing_box, name = name, box_names = box_names.get(name))
+
+    def rhs(self, t, M, a = 0):
+        """Right hand side of the mass flux ODEs, only a matrix-vector product
+        plus the emissions forcing
+
+        Parameters
+        ----------
+        t: float
+            Time (yr)
+        M: N-length array, or NxK array when called with vectorized = True
+            Mass in each box
+        a: int, str or EmissionsScenario
+            The forcing scenario to use, see MassFlux and get_scenario
+
+        Returns
+        -------
+        dMdt: N-length array (or NxK array)
+            Mass flux for one timestep
+        """
+        dMdt = self.k @ M
+        scenario = get_scenario(a)
+        if not scenario.is_zero:
+            dMdt[self.forcing_box] += scenario(t)
+        return dMdt
+
+    def jacobian(self, sparse = False):
+        """Jacobian of rhs with respect to M, the constant rate matrix k
+
+        Parameters
+        ----------
+        sparse: bool
+            Return a scipy.sparse CSR matrix instead of a dense array
+
+        Returns
+        -------
+        J: NxN array or csr_matrix
+            dF/dM, for the implicit solve_ivp methods (Radau, BDF, LSODA)
+        """
+        if sparse:
+            from scipy.sparse import csr_matrix
+            return csr_matrix(self.k)
+        return self.dense_k()
+
+    def jac(self, t, M, a = 0):
+        """Jacobian as a function of (t, M, a), for solvers that need a callable"""
+        return self.k
+
+    def steady_state(self, forcing = None, total_mass = None):
+        """Equilibrium masses, k*M + forcing = 0, found with one linear solve
+        instead of a long steady run. The network conserves mass, so k is
+        singular; the total mass is added as an extra equation to pin down
+        the solution along its null space
+
+        Parameters
+        ----------
+        forcing: N-length array
+            Constant forcing of each box (GtC/yr), e.g. a transfer between
+            boxes that the fluxes do not include. Must sum to zero, a net
+            input has no equilibrium (the total mass grows linearly), so a
+            scalar, which would all go into the forcing box, is not accepted.
+            Defaults to no forcing
+        total_mass: float
+            Total carbon in the system (Gt), defaults to the sum of M0. E.g.
+            sum(M0) plus cumulative emissions gives the equilibrium reached
+            long after the emissions stop
+
+        Returns
+        -------
+        M_eq: N-length array
+            Equilibrium mass in each box
+        """
+        f = np.zeros(self.n_boxes)
+        if forcing is not None:
+            if np.ndim(forcing) == 0:
+                raise ValueError("forcing must be an N-length array summing to zero, a constant input "
+                                 "into the forcing box has no equilibrium")
+            f[:] = forcing
+        if abs(f.sum()) > 1e-12*max(1., np.abs(f).max()):
+            raise ValueError("A net constant input of %g GtC/yr has no equilibrium, the total mass grows linearly" % f.sum())
+        if total_mass is None:
+            total_mass = self.M0.sum()
+
+        A = np.vstack([self.dense_k(), np.ones(self.n_boxes)])
+        rhs = np.append(-f, total_mass)
+        M_eq, _, rank, _ = np.linalg.lstsq(A, rhs, rcond = None)
+        if rank < self.n_boxes:
+            raise ValueError("The equilibrium is not unique, the box network is not connected")
+        return M_eq
+
+    def timescales(self):
+        """e-folding timescales of the relaxation modes, -1/Re(eigenvalue) of k,
+        leaving out the zero eigenvalue of the conserved total mass
+
+        Returns
+        -------
+        tau: 1D array
+            Timescales (yr), sorted from fastest to slowest
+        """
+        lam = np.linalg.eigvals(self.dense_k())
+        lam = lam[np.abs(lam) > 1e-10*np.abs(lam).max()]
+        return np.sort(-1./lam.real)
+
+@functools.lru_cache(maxsize = None)
+def get_model(name):
+    """Precompiled model for one of the topologies in Initialize.box_models,
+    built on first request and cached
+
+    Parameters
+    ----------
+    name: str
+        Configuration name, '4box' or '9box'
+
+    Returns
+    -------
+    model: BoxModel
+    """
+    return BoxModel.from_config(name)
+
+## Configuration names by state length, used by MassFlux to find its model
+_model_names = {len(M0): name for name, (F_in, M0) in box_models.items()}
+
 def MassFlux(t, M, a, b):
     """Mass flux coupled ODEs for 4-box or 9-box model of carbon cycle in a 
     steady state forced by anthropogenic CO2 emissions
@@ -82,45 +444,85 @@ def MassFlux(t, M, a, b):
             0: No forcings, steady state
             1: IPCC A2 Emissions forcings
             2: IPCC A2 modified so 2000 emissions beyond 2110
-            3: some fun periodic forcing
-            4: damped sinusoid
+            3: sine periodic forcing
+            4: damped (exponential) periodic forcing
+            5: IPCC A1T
+            6: cos periodic forcing
+            7: IPCC A1FI
+        or the name of a scenario in the registry (see get_scenario)
     Returns
     -------
     dMdt: M-length array
         Mass flux for one timestep
     """
-    global Flux_in_4, Flux_in_9
+    ## k is precompiled once per topology in BoxModel instead of at every call
+    return get_model(_model_names[len(M)]).rhs(t, M, a)
 
-    ## Flux in and Flux out values, units Gt/yr, to find k values
-    if len(M) == 4:
-        k = Find_k(Flux_in_4, M0_4)
-    else:
-        k = Find_k(Flux_in_9, M0_9)
-
-    # The actual matrix multiplication
-    dMdt = np.matmul(k, M)
-
-    # Forcings are adding mass to Carbon box in position 0 of the mass vector
-    if a==1:
-        dMdt[0] += emissions(t) ## adding forcing from emissions function at each timestep
-    elif a==2:
-        dMdt[0] += emissions(t, opt = 0) ## adding forcing from emissions function at each timestep (maintain 2100 levels)
-    elif a==3:
-        dMdt[0] += emissions(t, opt = 1) # sine periodic forcing
-    elif a==4:
-        dMdt[0] += emissions(t, opt = 2) # exponential periodic forcing
-    elif a==5:
-        dMdt[0] += emissions(t, opt = 3) # try other emissions forcing (A1T)
-    elif a==6:
-        dMdt[0] += emissions(t, opt = 4) # cos periodic forcing
-    elif a==7:
-        dMdt[0] += emissions(t, opt = 5) # try other emissions forcing (A1FI)
-    
-
-    return dMdt
+class _NeedsComplex(Exception):
+    """Raised by _rk4_steps when a real-valued integration has to be redone in complex"""
+
+class _InvalidFlag:
+    """numpy error callback (np.errstate(invalid = 'call')) that only records
+    that an invalid operation happened, e.g. np.power of a negative number to
+    a fractional power, so the RK loops can check for it after each fxy call
+    without a per-call errstate"""
+    def __init__(self):
+        self.raised = False
+
+    def __call__(self, kind, flag):
+        self.raised = True
+
+    def domain_error(self, y):
+        """Whether fxy hit an invalid operation on finite y, which complex
+        arithmetic can evaluate (from non-finite y it is just a blow-up)"""
+        raised, self.raised = self.raised, False
+        return raised and bool(np.all(np.isfinite(y)))
+
+def _rk4_steps(fxy, X, y0, h, dtype):
+    """Fixed step RK4 loop with preallocated stage buffers and in-place
+    arithmetic, used by rk4. Raises _NeedsComplex if the integration is real
+    but fxy returns complex values, or hits an invalid operation on finite y;
+    a real run that overflows stays real"""
+    N = len(X) - 1
+    Y = np.empty((N+1, len(y0)), dtype = dtype)
+    Y[0,:] = y0
+    y = Y[0,:].copy()
+    k1, k2, k3, k4, tmp = (np.empty_like(y) for _ in range(5))
+    real = not np.iscomplexobj(y)
+    invalid = _InvalidFlag()
+
+    def stage(x, yy, out):
+        invalid.raised = False
+        f = fxy(x, yy)
+        if real and (np.iscomplexobj(f) or (invalid.raised and invalid.domain_error(yy))):
+            raise _NeedsComplex
+        np.multiply(f, h, out = out)
+
+    # raising on invalid operations would need an errstate per fxy call, the
+    # callback only sets a flag
+    with np.errstate(invalid = 'call', call = invalid) if real else contextlib.nullcontext():
+        for ii in range(N):
+            x = X[ii, 0]
+            stage(x, y, k1)
+            np.multiply(k1, 0.5, out = tmp); tmp += y
+            stage(x+h/2, tmp, k2)
+            np.multiply(k2, 0.5, out = tmp); tmp += y
+            stage(x+h/2, tmp, k3)
+            np.add(y, k3, out = tmp)
+            stage(x+h, tmp, k4)
+
+            k2 += k3; k2 *= 2.; k1 += k2; k1 += k4
+            k1 /= 6.
+            y += k1
+            Y[ii+1,:] = y
+    return Y
 
 def rk4(fxy, x0, xf, y0, N):
     """Runge-Kutta integration to solve odes to the 4th order
+    The integration is done in real arithmetic and only falls back to complex
+    when fxy returns complex values (e.g. np.power of a negative number to a 
+    fractional power)
+
     Parameters
     ----------
     fxy: function 
@@ -140,34 +542,195 @@ def rk4(fxy, x0, xf, y0, N):
         Numpy array containing values of the independent variable
     Y: 1D numpy array if one equation solved; M-D numpy array [y1(x) y2(x) ... ] 
             for multiple (M) equations
-        The estimated dependent variable at each value of the independent variable
+        The estimated dependent variable at each value of the independent variable,
+        real unless fxy returned complex values
         
     """
     # compute step size and size of output variables
     if N < 2:
         N = 2 #set minimum number for N
     h = (xf - x0) / N
-    X = np.zeros((N+1, 1))
-    P = np.max(np.shape(y0))
-    Y = np.zeros((N+1, P))*1j #make complex by multiplying by 1j; this way can add complex values to this during integration
-
-    #set initial conditions
-    x = x0
-    X[0] = x
-    y = [complex(val) for val in y0]  #make complex
-    Y[0,:] = y
-    
-    # begin computational loop
-    for ii in range(N):
-
-        k1 = np.array([h * val for val in fxy(x,y)]) #evaluate function fxy; depending on equation, k1-4 can be complex; this is why we make Y and y complex as well
-        k2 = np.array([h * val for val in fxy(x+h/2, y+k1/2)])
-        k3 = np.array([h * val for val in fxy(x+h/2, y+k2/2)])
-        k4 = np.array([h * val for val in fxy(x+h, y+k3)])
-
-        y += (k1 + 2*k2 + 2*k3 + k4) / 6.
-        x += h
-        X[ii+1] = x
-        Y[ii+1,:] = y
-    
+    X = (x0 + h*np.arange(N+1)).reshape(N+1, 1)
+    y0 = np.ravel(np.asarray(y0))
+
+    # begin computational loop, in real arithmetic if possible
+    if not np.iscomplexobj(y0):
+        try:
+            with np.errstate(invalid = 'ignore'):
+                return X, _rk4_steps(fxy, X, y0.astype(float), h, float)
+        except _NeedsComplex:
+            pass
+    return X, _rk4_steps(fxy, X, y0.astype(complex), h, complex)
+
+## Dormand-Prince 5(4) tableau: nodes, stage coefficients, 5th order weights
+## (also the last stage row, so the final stage is the next step's first, FSAL)
+## and the difference between the 5th and embedded 4th order weights
+_DP_C = np.array([0., 1/5, 3/10, 4/5, 8/9, 1.])
+_DP_A = [np.array([1/5]),
+         np.array([3/40, 9/40]),
+         np.array([44/45, -56/15, 32/9]),
+         np.array([19372/6561, -25360/2187, 64448/6561, -212/729]),
+         np.array([9017/3168, -355/33, 46732/5247, 49/176, -5103/18656])]
+_DP_B = np.array([35/384, 0., 500/1113, 125/192, -2187/6784, 11/84])
+_DP_E = np.array([71/57600, 0., -71/16695, 71/1920, -17253/339200, 22/525, -1/40])
+## continuous extension (Shampine 1986, as in scipy's RK45): within a step,
+## y(x + s*h) = y + h*sum_j s**(j+1) * (P.T @ K)[j], 4th order like the step
+_DP_P = np.array([[1., -8048581381/2820520608, 8663915743/2820520608, -12715105075/11282082432],
+                  [0., 0., 0., 0.],
+                  [0., 131558114200/32700410799, -68118460800/10900136933, 87487479700/32700410799],
+                  [0., -1754552775/470086768, 14199869525/1410260304, -10690763975/1880347072],
+                  [0., 127303824393/49829197408, -318862633887/49829197408, 701980252875/199316789632],
+                  [0., -282668133/205662961, 2019193451/616988883, -1453857185/822651844],
+                  [0., 40617522/29380423, -110615467/29380423, 69997945/29380423]])
+
+def _error_norm(err, y, y_new, rtol, atol):
+    """RMS of the scaled error over the last axis, worst member of a batch"""
+    scale = atol + rtol*np.maximum(np.abs(y), np.abs(y_new))
+    return np.sqrt(np.mean(np.abs(err/scale)**2, axis = -1)).max()
+
+def _dopri_steps(fxy, x0, xf, y0, rtol, atol, h0, max_step, stops, max_steps, dense = False):
+    """Adaptive Dormand-Prince loop used by rk45. Returns the accepted step
+    times, states and derivatives, the number of fxy calls and of rejected
+    steps, and if dense the interpolant coefficients of each step (None
+    otherwise). Raises _NeedsComplex like _rk4_steps; a non-finite stage
+    (e.g. an overflowing trial step) is rejected and the step shrunk"""
+    real = not np.iscomplexobj(y0)
+    invalid = _InvalidFlag()
+
+    def f(x, y):
+        invalid.raised = False
+        fy = np.asarray(fxy(x, y))
+        if real and (np.iscomplexobj(fy) or (invalid.raised and invalid.domain_error(y))):
+            raise _NeedsComplex
+        return fy
+
+    with np.errstate(invalid = 'call', call = invalid) if real else contextlib.nullcontext():
+        x, y = x0, y0
+        fy = f(x, y)
+        nfev, rejected = 1, 0
+        if h0 is None:
+            # initial step from the size of y and f, refined with the change of f (Hairer)
+            scale = atol + rtol*np.abs(y)
+            d0, d1 = np.sqrt(np.mean(np.abs(y/scale)**2)), np.sqrt(np.mean(np.abs(fy/scale)**2))
+            h = 1e-6 if d0 < 1e-5 or d1 < 1e-5 else 0.01*d0/d1
+            h = min(h, xf - x0)
+            d2 = np.sqrt(np.mean(np.abs((f(x + h, y + h*fy) - fy)/scale)**2))/h
+            nfev += 1
+            h1 = max(1e-6, h*1e-3) if max(d1, d2) <= 1e-15 else (0.01/max(d1, d2))**(1/5)
+            h0 = min(100*h, h1)
+        h = min(h0, max_step)
+
+        X, Y, F, Q = [x], [y], [fy], []
+        K = np.empty((7,) + y.shape, dtype = y.dtype)
+        stops = list(stops) + [xf]
+        si = 0
+        while x < xf:
+            if len(X) > max_steps:
+                raise RuntimeError("rk45 took more than %d steps, reached x = %g" % (max_steps, x))
+            while stops[si] <= x:
+                si += 1
+            x_stop = stops[si]
+            h = min(h, max_step, x_stop - x)
+            if h < 10*np.spacing(max(abs(x), 1.)):
+                raise RuntimeError("rk45 step size too small at x = %g" % x)
+
+            K[0] = fy
+            for ii, a in enumerate(_DP_A):
+                K[ii+1] = f(x + _DP_C[ii+1]*h, y + h*np.tensordot(a, K[:ii+1], axes = 1))
+            x_new = x_stop if x + h >= x_stop else x + h # land exactly on stops
+            y_new = y + h*np.tensordot(_DP_B, K[:6], axes = 1)
+            K[6] = f(x_new, y_new)
+            nfev += 6
+            err = _error_norm(h*np.tensordot(_DP_E, K, axes = 1), y, y_new, rtol, atol)
+
+            if err <= 1.:
+                if dense:
+                    Q.append(h*np.tensordot(_DP_P.T, K, axes = 1))
+                x, y, fy = x_new, y_new, K[6].copy() # FSAL, the last stage is the next step's first
+                X.append(x); Y.append(y); F.append(fy)
+                h *= 10. if err == 0 else min(10., max(0.2, 0.9*err**-0.2))
+            else:
+                rejected += 1
+                h *= max(0.2, 0.9*err**-0.2)
+    return np.array(X), np.array(Y), np.array(F), nfev, rejected, np.array(Q) if dense else None
+
+def rk45(fxy, x0, xf, y0, rtol = 1e-6, atol = 1e-8, x_eval = None, breakpoints = None, h0 = None,
+         max_step = np.inf, max_steps = 100000, full_output = False):
+    """Adaptive Runge-Kutta integration with the Dormand-Prince 5(4) pair: the
+    step size is chosen from the embedded error estimate, so the caller gives
+    a tolerance instead of a number of intervals. Same fxy(x, y) interface as
+    rk4, and like rk4 the integration is real unless fxy returns complex values
+
+    Parameters
+    ----------
+    fxy: function 
+        The name of the function containing f(x,y) (e.g. oneode, twoode)
+    x0: int OR float 
+        Initial values of the independent variable 
+    xf: int OR float 
+        Final values of the independent variable, > x0
+    y0: numpy array 
+        Initial value of dependent variable at x0; an (S, M) array integrates
+        a batch of S states at once (fxy then receives and returns (S, M)
+        arrays and the step is set by the worst member)
+    rtol, atol: float
+        Relative and absolute tolerance of the local error
+    x_eval: 1D array
+        Values of x to return the solution at, from the Dormand-Prince
+        continuous extension of each step (4th order, within a small factor
+        of the step error); by default every accepted step is returned
+    breakpoints: 1D array
+        Values of x where fxy has a kink (e.g. the emission knots), the
+        integration steps exactly onto them instead of across
+    h0: float
+        Initial step size, estimated from fxy by default
+    max_step: float
+        Largest step size allowed
+    max_steps: int
+        Raises RuntimeError after this many steps
+    full_output: bool
+        Whether to also return a dict of counters
+
+    Returns
+    -------
+    X: numpy array
+        (n, 1) array of the values of the independent variable
+    Y: numpy array
+        (n, M) array (or (n, S, M) for a batch) of the dependent variable
+    info: dict
+        Only with full_output: nfev (fxy calls), n_steps, n_rejected and
+        x_steps (the accepted step ends)
+    """
+    if not xf > x0:
+        raise ValueError("xf must be greater than x0")
+    y0 = np.asarray(y0)
+    if y0.ndim == 0:
+        y0 = y0.reshape(1)
+    stops = [] if breakpoints is None else \
+        sorted(float(s) for s in np.ravel(breakpoints) if x0 < s < xf)
+    args = (x0, xf, None, rtol, atol, h0, max_step, stops, max_steps, x_eval is not None)
+
+    Xs = None
+    if not np.iscomplexobj(y0):
+        try:
+            with np.errstate(invalid = 'ignore', over = 'ignore'):
+                Xs, Ys, Fs, nfev, rejected, Qs = _dopri_steps(fxy, *args[:2], y0.astype(float), *args[3:])
+        except _NeedsComplex:
+            pass
+    if Xs is None:
+        Xs, Ys, Fs, nfev, rejected, Qs = _dopri_steps(fxy, *args[:2], y0.astype(complex), *args[3:])
+
+    if x_eval is None:
+        X, Y = Xs, Ys
+    else:
+        X = np.asarray(x_eval, dtype = float)
+        if np.any(X < x0) or np.any(X > xf):
+            raise ValueError("x_eval must be within [x0, xf]")
+        # the continuous extension of the step each x falls in
+        i = np.clip(np.searchsorted(Xs, X, side = 'right') - 1, 0, len(Xs) - 2)
+        s = ((X - Xs[i])/(Xs[i+1] - Xs[i])).reshape((-1,) + (1,)*(Ys.ndim - 1))
+        Y = Ys[i] + sum(s**(j+1)*Qs[i, j] for j in range(4))
+    X = X.reshape(-1, 1)
+    if full_output:
+        return X, Y, {'nfev': nfev, 'n_steps': len(Xs) - 1, 'n_rejected': rejected, 'x_steps': Xs}
     return X, Y
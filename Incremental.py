@@ -0,0 +1,219 @@
+from collections import OrderedDict
+import numpy as np
+from Functions import Result, get_scenario
+from Store import model_fingerprint
+
+## Incremental re-solves of scenario and model variants. Every run checkpoints
+## its state at fixed years; a new run is compared with the runs already done
+## to find the first year its inputs (emissions or model) differ, and is
+## resumed from the last checkpoint before that year instead of from the start.
+
+def forcing_divergence(a, b, t0 = -np.inf):
+    """Earliest time (>= t0) from which two emission scenarios differ
+
+    Both are piecewise linear, so they agree on a segment between two knots
+    (of either scenario) exactly when they agree at its ends
+
+    Parameters
+    ----------
+    a, b: int, str or Functions.EmissionsScenario
+        The scenarios to compare
+    t0: float
+        Start of the comparison
+
+    Returns
+    -------
+    t: float
+        The last knot before the first knot where they differ (t0 if they
+        differ from the start), inf if they are identical after t0
+    """
+    a, b = get_scenario(a), get_scenario(b)
+    knots = np.union1d(a.t_yr, b.t_yr)
+    knots = np.concatenate([[t0], knots[knots > t0]]) if np.isfinite(t0) else knots
+    differ = np.flatnonzero(a(knots) != b(knots))
+    if len(differ) == 0:
+        return np.inf
+    return knots[max(differ[0] - 1, 0)]
+
+def model_schedule(models):
+    """Normalizes a model or a list of (start year, model) pairs to a sorted
+    list of (start, model) pairs, the first starting at -inf"""
+    if not isinstance(models, (list, tuple)):
+        return [(-np.inf, models)]
+    sched = sorted(((float(start), model) for start, model in models), key = lambda s: s[0])
+    if not sched:
+        raise ValueError("Empty model schedule")
+    return [(-np.inf, sched[0][1])] + sched[1:]
+
+def _model_at(sched, t):
+    """Fingerprint of the model in effect at time t in a fingerprinted schedule"""
+    starts = [start for start, _, _ in sched]
+    return sched[np.searchsorted(starts, t, side = 'right') - 1][2]
+
+def _schedule_divergence(a, b, t0):
+    """Earliest time (>= t0) from which two fingerprinted model schedules differ"""
+    changes = sorted({t0} | {s for s, _, _ in a if s > t0} | {s for s, _, _ in b if s > t0})
+    for t in changes:
+        if _model_at(a, t) != _model_at(b, t):
+            return t
+    return np.inf
+
+class IncrementalSolver:
+    """Runs box model variants, reusing the checkpoints of earlier runs up to
+    the first year each variant differs from them
+
+    Parameters
+    ----------
+    checkpoint_every: float
+        Years between checkpoints, counted from each run's start
+    checkpoints: 1D array
+        Explicit checkpoint years, instead of checkpoint_every
+    method: str
+        'exact' (Solvers.solve_linear) or a solve_ivp method for Solvers.run_model
+    max_runs: int
+        Runs kept (least recently used are dropped)
+    **options
+        Passed on to run_model (rtol, atol, ...)
+    """
+    def __init__(self, checkpoint_every = 10., checkpoints = None, method = 'exact', max_runs = 32, **options):
+        self.checkpoint_every = checkpoint_every
+        self.checkpoints = None if checkpoints is None else np.unique(np.asarray(checkpoints, dtype = float))
+        self.method = method
+        self.options = options
+        self.max_runs = max_runs
+        self._runs = OrderedDict()
+        self._next_id = 0
+        self.solved_years = 0. # total span integrated, to compare with full re-solves
+
+    def _checkpoint_times(self, t0, tf):
+        if self.checkpoints is not None:
+            c = self.checkpoints
+        else:
+            c = t0 + self.checkpoint_every * np.arange(1, int(np.floor((tf - t0) / self.checkpoint_every)) + 1)
+        return c[(c > t0) & (c <= tf)]
+
+    def _advance(self, sched, scenario, t_from, M_from, times):
+        """States at the sorted times (all > t_from), switching models at the
+        schedule's start years"""
+        from Solvers import run_model, solve_linear
+
+        out = np.empty((len(M_from), len(times)))
+        starts = [s for s, _, _ in sched] + [np.inf]
+        t, M = t_from, np.asarray(M_from, dtype = float)
+        for (start, model, _), end in zip(sched, starts[1:]):
+            if end <= t:
+                continue
+            mask = (times > t) & (times <= end)
+            seg = times[mask]
+            stop = min(end, times[-1])
+            if stop <= t:
+                break
+            seg_eval = seg if len(seg) and seg[-1] == stop else np.append(seg, stop)
+            if self.method == 'exact':
+                y = solve_linear(model, seg_eval, scenario, M0 = M, t0 = t)
+            else:
+                res = run_model(model, (t, stop), scenario, method = self.method, t_eval = seg_eval,
+                                M0 = M, **self.options)
+                if not res.success:
+                    raise RuntimeError("%s failed at t = %g: %s" % (self.method, t, res.message))
+                y = res.y
+            out[:, mask] = y[:, :len(seg)]
+            self.solved_years += stop - t
+            t, M = stop, y[:, -1]
+        return out
+
+    def run(self, models, t_eval, scenario = 1, M0 = None, t0 = None):
+        """Solves one variant, resuming from the latest checkpoint of an earlier
+        run whose inputs are identical up to it
+
+        Parameters
+        ----------
+        models: Functions.BoxModel or list of (start year, BoxModel)
+            The model, or a schedule of models each in effect from its start
+            year (e.g. the base model and, from 2000, one with deforestation)
+        t_eval: 1D array
+            Increasing output times (yr)
+        scenario: int, str or Functions.EmissionsScenario
+            The forcing scenario to use, see Functions.get_scenario
+        M0: N-length array
+            Initial masses, defaults to those of the first model
+        t0: float
+            Time of M0, defaults to t_eval[0]
+
+        Returns
+        -------
+        result: Result
+            t and y (n_boxes, n_t) as from solve_linear; resumed_from: the
+            checkpoint year the solve started from (t0 for a full solve);
+            solved_years: the span integrated for this run
+        """
+        sched = [(start, model, model_fingerprint(model)) for start, model in model_schedule(models)]
+        scenario = get_scenario(scenario)
+        t_eval = np.asarray(t_eval, dtype = float)
+        if t_eval.ndim != 1 or len(t_eval) == 0 or np.any(np.diff(t_eval) <= 0):
+            raise ValueError("t_eval must be an increasing, non-empty 1D array")
+        t0 = t_eval[0] if t0 is None else float(t0)
+        if t_eval[0] < t0:
+            raise ValueError("t_eval must not start before t0")
+        M0 = np.array(sched[0][1].M0 if M0 is None else M0, dtype = float)
+        tf = t_eval[-1]
+
+        # the earlier run that agrees with this one for longest
+        best, diverge = None, t0
+        for run_id, run in self._runs.items():
+            if run['t0'] != t0 or not np.array_equal(run['M0'], M0):
+                continue
+            d = min(forcing_divergence(run['scenario'], scenario, t0), _schedule_divergence(run['sched'], sched, t0))
+            if d > diverge:
+                best, diverge = run_id, d
+
+        solved_before = self.solved_years
+        ck_t = self._checkpoint_times(t0, tf)
+        ck_M = np.empty((len(M0), len(ck_t)))
+        y = np.empty((len(M0), len(t_eval)))
+        start, M_start = t0, M0
+        if best is not None:
+            run = self._runs[best]
+            self._runs.move_to_end(best)
+            usable = run['ck_t'] <= min(diverge, tf)
+            if np.any(usable):
+                start, M_start = run['ck_t'][usable][-1], run['ck_M'][:, usable][:, -1]
+            # checkpoints and outputs up to the resume point are the earlier run's
+            shared = ck_t <= start
+            idx = np.searchsorted(run['ck_t'], ck_t[shared])
+            ck_M[:, shared] = run['ck_M'][:, idx]
+            before = t_eval <= start
+            have = np.isin(t_eval[before], run['t'])
+            y[:, np.flatnonzero(before)[have]] = run['y'][:, np.searchsorted(run['t'], t_eval[before][have])]
+            missing = np.flatnonzero(before)[~have]
+            if len(missing): # output times the earlier run did not have, solved from t0
+                self._fill(y, sched, scenario, t0, M0, t_eval, missing)
+        after = t_eval > start
+        at_start = t_eval == start
+        y[:, at_start] = M_start[:, None]
+        todo = np.union1d(t_eval[after], ck_t[ck_t > start])
+        if len(todo):
+            states = self._advance(sched, scenario, start, M_start, todo)
+            y[:, after] = states[:, np.searchsorted(todo, t_eval[after])]
+            new_ck = ck_t > start
+            ck_M[:, new_ck] = states[:, np.searchsorted(todo, ck_t[new_ck])]
+
+        self._runs[self._next_id] = {'t0': t0, 'M0': M0, 'scenario': scenario, 'sched': sched,
+                                     'ck_t': ck_t, 'ck_M': ck_M, 't': t_eval.copy(), 'y': y}
+        self._next_id += 1
+        while len(self._runs) > self.max_runs:
+            self._runs.popitem(last = False)
+        return Result(t = t_eval, y = y.copy(), resumed_from = start,
+                      solved_years = self.solved_years - solved_before)
+
+    def _fill(self, y, sched, scenario, t0, M0, t_eval, idx):
+        """Solves the outputs at t_eval[idx] from t0"""
+        t = t_eval[idx]
+        at0 = t == t0
+        y[:, idx[at0]] = M0[:, None]
+        if np.any(~at0):
+            y[:, idx[~at0]] = self._advance(sched, scenario, t0, M0, t[~at0])
+
+    def clear(self):
+        """Forgets all runs"""
+        self._runs.clear()
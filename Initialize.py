@@ -20,8 +20,6 @@ Flux_in_4 = np.array([[0, F21_4, F51_4, F71_4], \
                     [0, 0, F57_4, 0]])
 Flux_out_4 = Flux_in_4.T
 Mass_Flux_total_4 = sum(Flux_in_4 - Flux_out_4)
-if sum(Mass_Flux_total_4) == 0:
-    print('4 Box Net flux is 0')
 
 
 ## 9 BOX MODEL
@@ -59,10 +57,29 @@ Flux_out_9[1, 3] = F24
 Flux_in_9 = Flux_out_9.T
 # check for zero
 Mass_Flux_total_9 = sum(Flux_in_9 - Flux_out_9)
-if sum(Mass_Flux_total_9) == 0:
-    print('9 Box Net flux is 0')
 
 
 # The timespan to integrate over
 t_start = 1800; t_end= 2200; n = 200 # want 1800-2200 time interval
-t = np.linspace(t_start, t_end, n) # some time span
\ No newline at end of file
+t = np.linspace(t_start, t_end, n) # some time span
+
+## Box model configurations: flux-in matrix and initial masses for each topology,
+## used to build the precompiled models in Functions.py
+box_models = {'4box': (Flux_in_4, M0_4),
+              '9box': (Flux_in_9, M0_9)}
+
+## Names of the boxes of each configuration, in the order of M0
+box_names = {'4box': ['atmosphere', 'surface water', 'short-lived biota', 'litter'],
+             '9box': ['atmosphere', 'surface water', 'surface biota', 'intermediate and deep water',
+                      'short-lived biota', 'long-lived biota', 'litter', 'soil', 'peat']}
+
+## Atmospheric carbon per ppm of CO2 (GtC/ppm)
+PPM_TO_GTC = 2.124
+
+
+if __name__ == "__main__":
+    # check for zero net flux, run this file directly to see it (importing prints nothing)
+    if sum(Mass_Flux_total_4) == 0:
+        print('4 Box Net flux is 0')
+    if sum(Mass_Flux_total_9) == 0:
+        print('9 Box Net flux is 0')
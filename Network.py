@@ -0,0 +1,122 @@
+import json
+import os
+import numpy as np
+from Functions import BoxModel
+
+## Box model networks defined as an edge list in a JSON, TOML or YAML file:
+##
+##   {"name": "9box",
+##    "forcing_box": "atmosphere",
+##    "boxes": [{"name": "atmosphere", "mass": 725}, ...],
+##    "fluxes": [{"from": "surface water", "to": "atmosphere", "flux": 90}, ...]}
+##
+## masses in Gt, fluxes in Gt/yr. The network compiles to a sparse (CSR) rate
+## matrix, so regionalized models with hundreds of boxes stay cheap.
+
+def read_definition(path):
+    """Reads a model definition file, the format is chosen by its extension
+    (.json, .toml, or .yaml/.yml which needs PyYAML)
+
+    Returns
+    -------
+    definition: dict
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.json':
+        with open(path) as f:
+            return json.load(f)
+    if ext == '.toml':
+        import tomllib
+        with open(path, 'rb') as f:
+            return tomllib.load(f)
+    if ext in ('.yaml', '.yml'):
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError("Reading YAML model definitions needs PyYAML (pip install pyyaml)") from None
+        with open(path) as f:
+            return yaml.safe_load(f)
+    raise ValueError("Unknown model definition format '%s', expected .json, .toml or .yaml" % ext)
+
+def model_from_definition(definition, check_balance = True, rtol = 1e-9):
+    """Compiles a model definition into a BoxModel with a sparse rate matrix
+
+    Parameters
+    ----------
+    definition: dict
+        Model definition with boxes, fluxes and optionally name and forcing_box
+    check_balance: bool
+        Whether to require each box's fluxes in and out to balance, i.e. the
+        initial masses to be a steady state (as Initialize.py checks)
+    rtol: float
+        Tolerance of the balance check relative to the largest flux
+
+    Returns
+    -------
+    model: Functions.BoxModel
+    """
+    from scipy.sparse import coo_matrix
+
+    boxes = definition.get('boxes', [])
+    if not boxes:
+        raise ValueError("Model definition has no boxes")
+    names = [str(box['name']) for box in boxes]
+    if len(set(names)) != len(names):
+        raise ValueError("Duplicate box names in model definition")
+    index = {name: i for i, name in enumerate(names)}
+    M0 = np.array([float(box['mass']) for box in boxes])
+    if np.any(M0 <= 0):
+        raise ValueError("Box masses must be positive: %s" % [n for n, m in zip(names, M0) if m <= 0])
+
+    dst, src, flux = [], [], []
+    seen = set()
+    for edge in definition.get('fluxes', []):
+        for end in ('from', 'to'):
+            if edge[end] not in index:
+                raise ValueError("Flux refers to unknown box '%s'" % edge[end])
+        i, j, F = index[edge['to']], index[edge['from']], float(edge['flux'])
+        if i == j:
+            raise ValueError("Flux from box '%s' to itself" % edge['from'])
+        if (i, j) in seen:
+            raise ValueError("Duplicate flux from '%s' to '%s'" % (edge['from'], edge['to']))
+        if F < 0:
+            raise ValueError("Negative flux from '%s' to '%s', give the flux in the other direction" % (edge['from'], edge['to']))
+        seen.add((i, j))
+        dst.append(i); src.append(j); flux.append(F)
+
+    n = len(names)
+    dst, src, flux = np.array(dst, dtype = int), np.array(src, dtype = int), np.array(flux)
+    F_in = coo_matrix((flux, (dst, src)), shape = (n, n)).tocsr()
+    if check_balance:
+        net = np.bincount(dst, flux, minlength = n) - np.bincount(src, flux, minlength = n)
+        bad = np.abs(net) > rtol * max(1., flux.max(initial = 0.))
+        if np.any(bad):
+            raise ValueError("Fluxes do not balance (not a steady state) in boxes: %s"
+                             % ', '.join('%s (%+g)' % (names[i], net[i]) for i in np.flatnonzero(bad)))
+
+    forcing = definition.get('forcing_box', 0)
+    forcing_box = index[forcing] if isinstance(forcing, str) else int(forcing)
+    model = BoxModel(F_in, M0, forcing_box = forcing_box, name = definition.get('name'), box_names = names)
+
+    # transfers between boxes conserve mass: every column of k sums to zero
+    col = np.asarray(model.k.sum(axis = 0)).ravel()
+    if np.abs(col).max(initial = 0.) > 1e-9 * max(1., np.abs(model.k.data).max(initial = 0.)):
+        raise ValueError("Rate matrix does not conserve mass")
+    return model
+
+def load_model(path, check_balance = True):
+    """Loads a box model from a JSON/TOML/YAML edge list file, see read_definition
+    and model_from_definition"""
+    return model_from_definition(read_definition(path), check_balance = check_balance)
+
+def model_definition(model):
+    """Edge list definition of a BoxModel, the inverse of model_from_definition,
+    e.g. to write a model to a JSON file with json.dump"""
+    dst, src = model.F_in.nonzero()
+    F = np.asarray(model.F_in[dst, src]).ravel()
+    names = model.box_names
+    return {'name': model.name,
+            'forcing_box': names[model.forcing_box],
+            'boxes': [{'name': name, 'mass': float(m)} for name, m in zip(names, model.M0)],
+            'fluxes': [{'from': names[j], 'to': names[i], 'flux': float(f)}
+                       for i, j, f in zip(dst, src, F) if f != 0]}
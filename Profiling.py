@@ -0,0 +1,213 @@
+import functools
+import json
+import sys
+import time
+from collections import defaultdict
+import numpy as np
+
+## Opt-in profiling of the box model hot paths. Nothing is instrumented until a
+## Profiler is entered: it then swaps the functions below for timing wrappers
+## and puts the originals back on exit, so normal runs pay no overhead.
+##
+##   with Profiler() as prof:
+##       run_model(get_model('9box'), (1800, 2200), 'A2', method = 'Radau')
+##   print(prof.report())
+
+## (module, name) of the instrumented functions, patched in every loaded module
+## that imported them (e.g. with from Functions import *)
+_functions = [('Functions', 'MassFlux'),
+              ('Functions', 'Find_k'),
+              ('Functions', 'emissions'),
+              ('Functions', 'get_scenario')]
+## (module, class, method) of the instrumented methods, patched on the class
+_methods = [('Functions', 'BoxModel', 'rhs'),
+            ('Functions', 'BoxModel', 'jac'),
+            ('Functions', 'EmissionsScenario', '__call__'),
+            ('FluxLaws', 'NonlinearBoxModel', 'rhs'),
+            ('FluxLaws', 'NonlinearBoxModel', 'jac'),
+            ('Schedules', 'ScheduledBoxModel', 'rhs'),
+            ('Schedules', 'ScheduledBoxModel', 'jac')]
+
+class Profiler:
+    """Records call counts, inclusive and self time of the RHS and forcing
+    functions, and the step sizes taken by rk4, rk45 and the solve_ivp solvers,
+    while used as a context manager. Not thread safe: profile one solve (or
+    one worker process) at a time
+
+    Parameters
+    ----------
+    trace: bool
+        Whether to keep one event per call for chrome_trace, as well as the totals
+    max_events: int
+        Most trace events kept, later calls are still counted
+    """
+    def __init__(self, trace = False, max_events = 1000000):
+        self.trace = trace
+        self.max_events = max_events
+        self.calls = defaultdict(int)
+        self.total = defaultdict(float)   # s, including nested instrumented calls
+        self.self_time = defaultdict(float) # s, excluding them
+        self.steps = defaultdict(list)    # solver -> [(wall clock, t, step size)]
+        self.events = []                  # (name, start, end) wall clock
+        self._stack = []                  # time spent in children of each open call
+        self._patches = []
+        self._t_start = self._t_stop = None
+
+    def _timed(self, name, func):
+        calls, total, self_time, events, stack = self.calls, self.total, self.self_time, self.events, self._stack
+        trace, max_events, clock = self.trace, self.max_events, time.perf_counter
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            stack.append(0.)
+            start = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                end = clock()
+                elapsed = end - start
+                children = stack.pop()
+                calls[name] += 1
+                total[name] += elapsed
+                self_time[name] += elapsed - children
+                if stack:
+                    stack[-1] += elapsed
+                if trace and len(events) < max_events:
+                    events.append((name, start, end))
+        return wrapper
+
+    def _patch(self, owner, name, new):
+        self._patches.append((owner, name, owner.__dict__[name] if isinstance(owner, type) else getattr(owner, name)))
+        setattr(owner, name, new)
+
+    def __enter__(self):
+        if self._patches:
+            raise RuntimeError("Profiler is already active")
+        import Functions
+
+        for mod_name, name in _functions:
+            orig = getattr(sys.modules[mod_name], name)
+            wrapper = self._timed(name, orig)
+            for mod in list(sys.modules.values()):
+                if getattr(mod, '__dict__', {}).get(name) is orig:
+                    self._patch(mod, name, wrapper)
+        for mod_name, cls_name, name in _methods:
+            if mod_name in sys.modules: # only classes in use, nothing is imported for profiling
+                cls = getattr(sys.modules[mod_name], cls_name)
+                self._patch(cls, name, self._timed('%s.%s' % (cls_name, name), cls.__dict__[name]))
+
+        ## step sizes: rk4's fixed steps and every accepted rk45 and solve_ivp step
+        rk4_steps = Functions._rk4_steps
+        steps, clock = self.steps, time.perf_counter
+
+        def _rk4_steps(fxy, X, y0, h, dtype):
+            Y = rk4_steps(fxy, X, y0, h, dtype)
+            now = clock()
+            steps['rk4'].extend((now, x, h) for x in X[:-1, 0])
+            return Y
+        self._patch(Functions, '_rk4_steps', self._timed('rk4', _rk4_steps))
+        dopri_steps = Functions._dopri_steps
+
+        def _dopri_steps(*args):
+            out = dopri_steps(*args)
+            now, X = clock(), out[0]
+            steps['rk45'].extend((now, x, h) for x, h in zip(X[:-1], np.diff(X)))
+            return out
+        self._patch(Functions, '_dopri_steps', self._timed('rk45', _dopri_steps))
+        try:
+            from scipy.integrate import OdeSolver
+        except ImportError: # rk4 only
+            OdeSolver = None
+        if OdeSolver is not None:
+            solver_step = OdeSolver.step
+
+            def step(solver):
+                t_old = solver.t
+                message = solver_step(solver)
+                if solver.t != t_old:
+                    steps[type(solver).__name__].append((clock(), t_old, solver.t - t_old))
+                return message
+            self._patch(OdeSolver, 'step', self._timed('OdeSolver.step', step))
+        self._t_start = clock()
+        return self
+
+    def __exit__(self, *exc):
+        self._t_stop = time.perf_counter()
+        for owner, name, orig in reversed(self._patches):
+            setattr(owner, name, orig)
+        self._patches = []
+        return False
+
+    def step_sizes(self, solver):
+        """Step history of a solver ('rk4', 'rk45', 'RK45', 'Radau', ...)
+
+        Returns
+        -------
+        t: 1D array
+            Start of each step (yr)
+        h: 1D array
+            Step size (yr)
+        """
+        arr = np.array(self.steps.get(solver, []), dtype = float).reshape(-1, 3)
+        return arr[:, 1], arr[:, 2]
+
+    def summary(self):
+        """Counters as a plain (JSON-serializable) dict
+
+        Returns
+        -------
+        summary: dict
+            wall_s, the time inside the profiler; functions, per instrumented
+            function its calls, total_s, self_s and mean_us (per call); steps,
+            per solver n_steps and h_min, h_mean, h_max (yr)
+        """
+        functions = {name: {'calls': self.calls[name], 'total_s': self.total[name],
+                            'self_s': self.self_time[name],
+                            'mean_us': 1e6*self.total[name]/self.calls[name]}
+                     for name in sorted(self.calls, key = self.total.get, reverse = True)}
+        steps = {}
+        for solver in self.steps:
+            h = self.step_sizes(solver)[1]
+            steps[solver] = {'n_steps': len(h), 'h_min': float(h.min()), 'h_mean': float(h.mean()),
+                             'h_max': float(h.max())}
+        stop = time.perf_counter() if self._t_stop is None or self._patches else self._t_stop
+        return {'wall_s': stop - self._t_start if self._t_start is not None else 0.,
+                'functions': functions, 'steps': steps}
+
+    def report(self):
+        """Summary as a plain text table"""
+        s = self.summary()
+        lines = ['%-28s %10s %10s %10s %10s' % ('function', 'calls', 'total_s', 'self_s', 'mean_us')]
+        lines += ['%-28s %10d %10.4f %10.4f %10.2f' % (name, f['calls'], f['total_s'], f['self_s'], f['mean_us'])
+                  for name, f in s['functions'].items()]
+        lines += ['%-28s %10d steps, h %.3g .. %.3g yr (mean %.3g)'
+                  % (solver, st['n_steps'], st['h_min'], st['h_max'], st['h_mean'])
+                  for solver, st in s['steps'].items()]
+        lines.append('wall time %.4f s' % s['wall_s'])
+        return '\n'.join(lines)
+
+    def chrome_trace(self, path = None):
+        """Trace events in the Chrome trace format (chrome://tracing, Perfetto):
+        one complete event per recorded call (with trace = True) and a step
+        size counter per solver
+
+        Parameters
+        ----------
+        path: str
+            File to write the JSON to, None to only return it
+
+        Returns
+        -------
+        trace: dict
+        """
+        t0 = self._t_start or 0.
+        events = [{'name': name, 'cat': 'boxmodel', 'ph': 'X', 'pid': 0, 'tid': 0,
+                   'ts': 1e6*(start - t0), 'dur': 1e6*(end - start)} for name, start, end in self.events]
+        for solver, history in self.steps.items():
+            events += [{'name': 'step size %s' % solver, 'ph': 'C', 'pid': 0, 'tid': 0,
+                        'ts': 1e6*(wall - t0), 'args': {'h_yr': h}} for wall, t, h in history]
+        trace = {'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': self.summary()}
+        if path is not None:
+            with open(path, 'w') as f:
+                json.dump(trace, f)
+        return trace
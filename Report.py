@@ -0,0 +1,285 @@
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from Functions import get_scenario
+from Initialize import box_names
+from Trajectory import Trajectory
+
+## Batch rendering of result figures with matplotlib's object oriented API on
+## the Agg canvas (no pyplot state), decimating long series first and drawing
+## the figures in parallel worker processes. matplotlib is imported inside the
+## functions that draw, so importing this module stays cheap.
+
+## boxes drawn in each panel of the scenario and method figures
+default_boxes = ('atmosphere', 'surface water')
+_margins = dict(left = 0.16, right = 0.97, bottom = 0.07, top = 0.94, hspace = 0.12)
+
+def decimate(t, y, max_points = 2000):
+    """Thins a series to at most about max_points points, keeping the min and
+    max of each bucket of points in time order, so peaks and oscillations
+    survive (plain striding can step over them)
+
+    Parameters
+    ----------
+    t: 1D array
+        Times
+    y: 1D array
+        Values at those times
+    max_points: int
+        Target number of points
+
+    Returns
+    -------
+    t, y: 1D arrays
+        The thinned series, the input itself if it is short enough
+    """
+    n = len(t)
+    if n <= max_points:
+        return t, y
+    size = -(-n // max(1, max_points // 2)) # points per bucket, two kept from each
+    n_buckets = -(-n // size)
+    idx = np.minimum(np.arange(n_buckets * size), n - 1).reshape(n_buckets, size) # last bucket padded
+    vals = y[idx]
+    lo = idx[np.arange(n_buckets), vals.argmin(axis = 1)]
+    hi = idx[np.arange(n_buckets), vals.argmax(axis = 1)]
+    keep = np.unique(np.concatenate([[0, n - 1], lo, hi]))
+    return t[keep], y[keep]
+
+def _load(source):
+    """Trajectory and label of a plot source: a Trajectory, a Trajectory file
+    (.npy) or a result store file (.npz, see Store.ResultStore)"""
+    if isinstance(source, Trajectory):
+        return source, None
+    if source.endswith('.npz'):
+        import json
+        with np.load(source, allow_pickle = False) as f:
+            config = json.loads(str(f['config']))
+            t, y = f['t'], f['y']
+        names, forcing_box = None, 0
+        spec = config.get('model')
+        if spec in box_names:
+            names = box_names[spec]
+        elif spec is not None and os.path.exists(spec): # a model definition file
+            from Network import load_model
+            model = load_model(spec)
+            names, forcing_box = model.box_names, model.forcing_box
+        return Trajectory(t, y, names, forcing_box = forcing_box), config
+    return Trajectory.load(source), None
+
+def _series(traj, box, max_points):
+    try:
+        return decimate(traj.t, traj.box(box), max_points)
+    except KeyError: # box not in this model, e.g. 'surface water' in a custom network
+        return None
+
+def scenario_figure(source, path, title = None, scenario = None, boxes = default_boxes, max_points = 2000,
+                    figsize = (6, 7), dpi = 100):
+    """Draws one run: the emissions (if the scenario is known) and one panel
+    per box, and writes it to path
+
+    Parameters
+    ----------
+    source: Trajectory or str
+        The run, or a Trajectory (.npy) or result store (.npz) file
+    path: str
+        Output file, the format follows the extension (.png, .pdf, ...)
+    title: str
+        Figure title, defaults to the scenario and solver of a store file
+    scenario: int, str or Functions.EmissionsScenario
+        Scenario to draw the emissions of, taken from a store file by default
+    boxes: sequence of str or int
+        Boxes to draw, one panel each
+    max_points: int
+        Points per line after decimation
+    figsize, dpi
+        Figure size (inches) and resolution
+
+    Returns
+    -------
+    path: str
+    """
+    from matplotlib.figure import Figure
+
+    traj, config = _load(source)
+    if config is not None:
+        scenario = config['scenario'] if scenario is None else scenario
+        title = '%s, %s' % (config['scenario'], config['solver']) if title is None else title
+    panels = ([None] if scenario is not None else []) + list(boxes)
+    fig = Figure(figsize = figsize, dpi = dpi)
+    axes = fig.subplots(len(panels), 1, sharex = True, squeeze = False)[:, 0]
+    for ax, box in zip(axes, panels):
+        if box is None:
+            sc = get_scenario(scenario)
+            t = traj.t
+            ax.plot(t, sc(t), color = 'k')
+            ax.set_ylabel('Emissions (GtC/yr)')
+            continue
+        series = _series(traj, box, max_points)
+        if series is not None:
+            ax.plot(*series)
+        ax.set_ylabel('%s (%s)' % (box if isinstance(box, str) else traj.box_names[box], traj.unit))
+    axes[-1].set_xlabel('Year')
+    if title:
+        fig.suptitle(title)
+    fig.subplots_adjust(**_margins) # fixed margins, tight_layout costs an extra draw
+    fig.savefig(path)
+    return path
+
+def _default_labels(configs):
+    """Legend labels of runs: the solver of store files plus the settings
+    (rtol, atol, steps) that differ between runs of the same solver"""
+    labels = []
+    for ii, config in enumerate(configs):
+        if not config:
+            labels.append('run %d' % (ii+1))
+            continue
+        same = [c for c in configs if c and c['solver'] == config['solver']]
+        extra = ['%s=%g' % (name, config[name]) for name in ('rtol', 'atol', 'steps')
+                 if name in config and len({c.get(name) for c in same}) > 1]
+        labels.append(' '.join([config['solver']] + extra))
+    return labels
+
+def method_figure(sources, path, labels = None, reference = None, title = None, boxes = default_boxes,
+                  max_points = 2000, figsize = (6, 7), dpi = 100):
+    """Draws several runs of the same scenario (e.g. one per solver) over each
+    other, one panel per box, plus the absolute difference of the first box
+    from a reference run
+
+    Parameters
+    ----------
+    sources: list of Trajectory or str
+        The runs, or Trajectory (.npy) or result store (.npz) files
+    path: str
+        Output file
+    labels: list of str
+        Legend labels, defaults to the solvers of store files and the
+        settings that differ between runs of the same solver
+    reference: int
+        Position in sources of the reference run, defaults to the first
+        'exact' run if there is one; None and no exact run draws no
+        difference panel
+    title, boxes, max_points, figsize, dpi
+        As for scenario_figure
+
+    Returns
+    -------
+    path: str
+    """
+    from matplotlib.figure import Figure
+
+    loaded = [_load(s) for s in sources]
+    trajs = [traj for traj, _ in loaded]
+    configs = [config for _, config in loaded]
+    if labels is None:
+        labels = _default_labels(configs)
+    if reference is None:
+        exact = [ii for ii, (label, config) in enumerate(zip(labels, configs))
+                 if (config['solver'] if config else label) == 'exact']
+        reference = exact[0] if exact else None
+    if title is None and loaded[0][1] is not None:
+        title = loaded[0][1]['scenario']
+
+    n_panels = len(boxes) + (reference is not None)
+    fig = Figure(figsize = figsize, dpi = dpi)
+    axes = fig.subplots(n_panels, 1, sharex = True, squeeze = False)[:, 0]
+    for ax, box in zip(axes, boxes):
+        for ii, (traj, label) in enumerate(zip(trajs, labels)):
+            series = _series(traj, box, max_points)
+            if series is not None:
+                ax.plot(*series, label = label, color = 'C%d' % ii)
+        ax.set_ylabel('%s (%s)' % (box, trajs[0].unit))
+    axes[0].legend(fontsize = 'small')
+    if reference is not None:
+        ax = axes[-1]
+        ref = trajs[reference]
+        for ii, (traj, label) in enumerate(zip(trajs, labels)):
+            if traj is ref:
+                continue
+            # on the reference's times, the runs may be stored on different grids
+            diff = np.abs(np.interp(ref.t, traj.t, traj.box(boxes[0])) - ref.box(boxes[0]))
+            ax.semilogy(*decimate(ref.t, np.maximum(diff, 1e-16), max_points), label = label, color = 'C%d' % ii)
+        ax.set_ylabel('|%s - %s| (%s)' % (boxes[0], labels[reference], ref.unit))
+    axes[-1].set_xlabel('Year')
+    if title:
+        fig.suptitle(title)
+    fig.subplots_adjust(**_margins) # fixed margins, tight_layout costs an extra draw
+    fig.savefig(path)
+    return path
+
+_figures = {'scenario': scenario_figure, 'method': method_figure}
+
+def _render(job):
+    kind, args, kwargs = job
+    return _figures[kind](*args, **kwargs)
+
+def render(jobs, n_workers = None):
+    """Renders figures in parallel worker processes
+
+    Parameters
+    ----------
+    jobs: list of (kind, args, kwargs)
+        kind 'scenario' or 'method', with the arguments of scenario_figure or
+        method_figure; pass file names rather than Trajectory objects so
+        the workers read the data themselves
+    n_workers: int
+        Worker processes, defaults to the CPU count; 1 renders in this process
+
+    Returns
+    -------
+    paths: list of str
+        Written files, in the order of jobs
+    """
+    for kind, _, _ in jobs:
+        if kind not in _figures:
+            raise ValueError("Unknown figure kind '%s', expected one of %s" % (kind, sorted(_figures)))
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if n_workers <= 1 or len(jobs) <= 1:
+        return [_render(job) for job in jobs]
+    n_workers = min(n_workers, len(jobs))
+    with ProcessPoolExecutor(max_workers = n_workers) as pool:
+        return list(pool.map(_render, jobs, chunksize = max(1, len(jobs) // (4 * n_workers))))
+
+def store_report(store_root, out_dir, fmt = 'png', boxes = default_boxes, n_workers = None, **options):
+    """Figures of every run in a result store (see carbonbox.py): one scenario
+    figure per run and, for scenarios run with more than one solver, a method
+    comparison figure
+
+    Parameters
+    ----------
+    store_root: str
+        Store directory
+    out_dir: str
+        Directory for the figures, created if missing
+    fmt: str
+        Image format (file extension)
+    boxes: sequence of str
+        Boxes to draw
+    n_workers: int
+        Worker processes, see render
+    **options
+        Passed on to the figure functions (max_points, dpi, ...)
+
+    Returns
+    -------
+    paths: list of str
+    """
+    import json
+
+    os.makedirs(out_dir, exist_ok = True)
+    jobs, by_scenario = [], {}
+    for path in sorted(glob.glob(os.path.join(store_root, '*', '*.npz'))):
+        with np.load(path, allow_pickle = False) as f:
+            config = json.loads(str(f['config']))
+        if not {'model', 'scenario', 'solver', 't_span'} <= set(config): # e.g. a Cache.SolveCache entry
+            continue
+        key = os.path.basename(path)[:12]
+        name = '%s_%s_%s' % (config['scenario'], config['solver'], key)
+        jobs.append(('scenario', (path, os.path.join(out_dir, '%s.%s' % (name, fmt))), dict(boxes = boxes, **options)))
+        by_scenario.setdefault((config['model'], config['scenario'], tuple(config['t_span'])), []).append(path)
+    for (model, scenario, t_span), paths in sorted(by_scenario.items()):
+        if len(paths) > 1:
+            name = 'methods_%s_%s_%g-%g' % (os.path.basename(str(model)).split('.')[0], scenario, *t_span)
+            jobs.append(('method', (paths, os.path.join(out_dir, '%s.%s' % (name, fmt))), dict(boxes = boxes, **options)))
+    return render(jobs, n_workers)
@@ -0,0 +1,183 @@
+import bisect
+import numpy as np
+from Functions import BoxModel, get_scenario
+
+## Time-varying fluxes, e.g. land use change. Each scheduled flux is a
+## piecewise linear table of years and values, like the emissions tables, and
+## enters the model as a correction to the constant rate matrix on its own
+## edge: a flux from box j to box i with rate change dk(t) adds
+##   dk(t)*M_j to box i and removes it from box j
+## a rank one update per edge. Between two schedule knots the rate matrix is
+## k_seg + (t - knot)*dk_seg, both built once per segment from these updates
+## when the segment is first reached, so the RHS costs one or two k @ M
+## products and k is never rebuilt inside a call. Sparse models apply the
+## per-edge updates in every call instead, to keep k sparse.
+##
+##   defor = ScheduledBoxModel(F_in_9, M0_9, {'F61': ([1850, 1950, 2000, 2100], [0, 1, 2, 0])})
+##   run_model(defor, (1800, 2200), 'A2', method = 'Radau')
+
+def flux_index(label):
+    """(i, j) index in F_in of a flux named like 'F61' (from box 6 to box 1),
+    the inverse of Sensitivity.flux_label; 'F12_3' for models with 10+ boxes"""
+    body = label[1:] if label[:1] == 'F' else ''
+    parts = body.split('_') if '_' in body else [body[:1], body[1:]] if len(body) == 2 else []
+    if len(parts) != 2 or not all(p.isdigit() and int(p) > 0 for p in parts):
+        raise ValueError("Cannot parse flux name '%s', expected e.g. 'F61' or 'F12_3'" % label)
+    return int(parts[1]) - 1, int(parts[0]) - 1
+
+class ScheduledBoxModel(BoxModel):
+    """Linear box model in which some fluxes follow schedules in time
+
+    The scheduled fluxes are piecewise linear between their knots and hold
+    their end values outside them; is_linear is False because the Jacobian
+    changes with time, so run_model gives the implicit methods jac(t, M)
+    and breaks the integration at the schedule knots as well as the emission
+    knots. The exact solvers need a constant rate matrix and refuse it;
+    dense_k, steady_state and timescales take the time to use, and at(t)
+    gives a constant BoxModel with the fluxes of that time
+
+    Parameters
+    ----------
+    F_in: NxN array or scipy.sparse matrix
+        Steady state flux-in values, as for BoxModel; they set the constant
+        rate matrix and the masses the flux schedules are defined at
+    M0: N-length vector
+        Initial (steady state) values of mass for each box
+    schedules: dict
+        Flux name ('F61', see flux_index) or (i, j) index -> (years, values):
+        the flux from box j to box i (GtC/yr at the steady state mass of box
+        j, scaled with its mass like every linear flux), or the rate constant
+        (1/yr) if rates is True
+    forcing_box, name, box_names
+        As for BoxModel
+    rates: bool
+        Whether the schedule values are rate constants instead of fluxes
+    """
+    is_linear = False
+
+    def __init__(self, F_in, M0, schedules, forcing_box = 0, name = None, box_names = None, rates = False):
+        super().__init__(F_in, M0, forcing_box = forcing_box, name = name, box_names = box_names)
+        if not schedules:
+            raise ValueError("No flux schedules given, use BoxModel for constant fluxes")
+        edges, tables = [], []
+        for key, (t_yr, values) in schedules.items():
+            i, j = flux_index(key) if isinstance(key, str) else (int(key[0]), int(key[1]))
+            if not (0 <= i < self.n_boxes and 0 <= j < self.n_boxes) or i == j:
+                raise ValueError("Flux schedule %r is not between two different boxes of the model" % (key,))
+            t_yr, values = np.asarray(t_yr, dtype = float), np.asarray(values, dtype = float)
+            if t_yr.ndim != 1 or t_yr.shape != values.shape or len(t_yr) == 0 or np.any(np.diff(t_yr) <= 0):
+                raise ValueError("Flux schedule %r needs increasing years and one value per year" % (key,))
+            edges.append((i, j)); tables.append((t_yr, values))
+        if len(set(edges)) != len(edges):
+            raise ValueError("More than one schedule for the same flux")
+        self.edges = edges
+        self.dst, self.src = (np.array(idx, dtype = int) for idx in zip(*edges))
+
+        # all schedules on the union of their knots, as rate changes from the constant k
+        self.knots = np.unique(np.concatenate([t for t, _ in tables]))
+        k_base = np.array([self.F_in[i, j] for i, j in edges], dtype = float) / self.M0[self.src]
+        scale = 1. if rates else 1. / self.M0[self.src]
+        self._dk = np.column_stack([np.interp(self.knots, t, v) for t, v in tables]) * scale - k_base
+        self._slope = np.diff(self._dk, axis = 0) / np.diff(self.knots)[:, None]
+        self._dk.flags.writeable = False
+        self._knot_list = self.knots.tolist()
+        self.schedule_arrays = (np.array(edges, dtype = float), self.knots, self._dk) # for Store.model_fingerprint
+
+        self._segments = {} # segment index -> (k at its start, dk/dt), built on first use
+        if self.is_sparse:
+            # incidence of the scheduled edges: +1 at the destination, -1 at the source
+            from scipy.sparse import csr_matrix
+            cols = np.arange(len(edges))
+            self._D = csr_matrix((np.concatenate([np.ones(len(edges)), -np.ones(len(edges))]),
+                                  (np.concatenate([self.dst, self.src]), np.concatenate([cols, cols]))),
+                                 shape = (self.n_boxes, len(edges)))
+
+    def delta_k(self, t):
+        """Rate constant change of every scheduled edge at time t (1/yr), in
+        the order of edges"""
+        ii = bisect.bisect_right(self._knot_list, t) - 1
+        if ii < 0:
+            return self._dk[0]
+        if ii >= len(self._slope):
+            return self._dk[-1]
+        return self._dk[ii] + self._slope[ii] * (t - self._knot_list[ii])
+
+    def _update(self, k, dk):
+        """k plus the rank one updates of the scheduled edges (dense)"""
+        k = k.copy()
+        np.add.at(k, (self.dst, self.src), dk)
+        np.add.at(k, (self.src, self.src), -dk)
+        return k
+
+    def _segment(self, ii):
+        """Rate matrix at the start of segment ii (-1 before the first knot)
+        and its change per year, None where the schedules are flat"""
+        seg = self._segments.get(ii)
+        if seg is None:
+            inside = 0 <= ii < len(self._slope)
+            k0 = self._update(self.k, self._dk[max(ii, 0)])
+            k1 = self._update(np.zeros_like(k0), self._slope[ii]) if inside and np.any(self._slope[ii]) else None
+            k0.flags.writeable = False
+            seg = self._segments[ii] = (k0, k1)
+        return seg
+
+    def rhs(self, t, M, a = 0):
+        """Right hand side with the rate matrix at time t, see BoxModel.rhs"""
+        if self.is_sparse:
+            dMdt = self.k @ M
+            dk = self.delta_k(t)
+            dMdt += self._D @ (dk * M[self.src] if M.ndim == 1 else dk[:, None] * M[self.src])
+        else:
+            ii = bisect.bisect_right(self._knot_list, t) - 1
+            k0, k1 = self._segments[ii] if ii in self._segments else self._segment(ii)
+            dMdt = k0 @ M
+            if k1 is not None:
+                dMdt += (t - self._knot_list[ii]) * (k1 @ M)
+        scenario = get_scenario(a)
+        if not scenario.is_zero:
+            dMdt[self.forcing_box] += scenario(t)
+        return dMdt
+
+    def k_at(self, t):
+        """Rate matrix in effect at time t (dense, or CSR for a sparse model)"""
+        dk = self.delta_k(t)
+        if self.is_sparse:
+            from scipy.sparse import coo_matrix
+            n = self.n_boxes
+            return (self.k + coo_matrix((np.concatenate([dk, -dk]),
+                                         (np.concatenate([self.dst, self.src]), np.concatenate([self.src, self.src]))),
+                                        shape = (n, n))).tocsr()
+        return self._update(self.k, dk)
+
+    def jac(self, t, M, a = 0):
+        """Jacobian of rhs, the rate matrix at time t"""
+        return self.k_at(t)
+
+    def jacobian(self, sparse = False):
+        raise ValueError("The Jacobian of a ScheduledBoxModel changes with time, use jac(t, M)")
+
+    def at(self, t):
+        """Constant BoxModel with the fluxes in effect at time t"""
+        F = self.F_in.tolil() if self.is_sparse else self.F_in.copy()
+        for (i, j), dk in zip(self.edges, self.delta_k(t)):
+            F[i, j] += dk * self.M0[j]
+        return BoxModel(F.tocsr() if self.is_sparse else F, self.M0, forcing_box = self.forcing_box,
+                        name = self.name, box_names = self.box_names)
+
+    def _at(self, t, what):
+        if t is None:
+            raise ValueError("The rate matrix of a ScheduledBoxModel changes with time, pass t to %s" % what)
+        return self.at(t)
+
+    def dense_k(self, t = None):
+        """The rate matrix at time t as a dense array"""
+        return self._at(t, 'dense_k').dense_k()
+
+    def steady_state(self, forcing = None, total_mass = None, t = None):
+        """Equilibrium masses if the fluxes stayed as they are at time t, see
+        BoxModel.steady_state"""
+        return self._at(t, 'steady_state').steady_state(forcing, total_mass)
+
+    def timescales(self, t = None):
+        """Relaxation timescales of the rate matrix at time t, see BoxModel.timescales"""
+        return self._at(t, 'timescales').timescales()
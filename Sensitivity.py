@@ -0,0 +1,80 @@
+import numpy as np
+from Functions import Result, get_scenario
+from Solvers import _solve_affine
+
+## Sensitivities of the box masses to the steady state fluxes
+
+def flux_edges(F_in):
+    """Non-zero fluxes of a flux-in array as (i, j) index pairs, F_in[i, j]
+    being the flux from box j to box i"""
+    dst, src = F_in.nonzero() # works for dense arrays and scipy.sparse matrices
+    order = np.lexsort((src, dst))
+    return [(int(dst[q]), int(src[q])) for q in order]
+
+def flux_label(i, j):
+    """Name of the flux from box j to box i in the Initialize.py convention, e.g. 'F21'"""
+    return 'F%d%d' % (j+1, i+1) if max(i, j) < 9 else 'F%d_%d' % (j+1, i+1)
+
+def flux_sensitivity(model, t_eval, scenario = 1, edges = None, box = 0, M0 = None, t0 = None):
+    """Derivatives of the box masses with respect to every flux, dM(t)/dF_ij,
+    from the forward sensitivity equations solved in one exact pass
+
+    With k = Find_k(F_in, M0), a flux F_ij (from box j to box i) enters k as
+    F_ij/M0_j at [i, j] and -F_ij/M0_j at [j, j], so S_ij = dM/dF_ij obeys
+        dS_ij/dt = k*S_ij + (M_j/M0_j)*(e_i - e_j),  S_ij(t0) = 0
+    All S_ij are appended to the mass equations and the whole block system is
+    advanced with the exact solver, instead of one perturbed run per flux
+
+    Parameters
+    ----------
+    model: Functions.BoxModel
+        Box model with the steady state fluxes F_in and masses M0
+    t_eval: 1D array
+        Non-decreasing times (yr) to return the sensitivities at
+    scenario: int, str or Functions.EmissionsScenario
+        The forcing scenario to use, see Functions.get_scenario
+    edges: list of (i, j) pairs
+        Fluxes to differentiate with respect to, defaults to all non-zero ones
+    box: int or None
+        Box whose mass is differentiated (0 is the atmosphere), None for all
+    M0: N-length array
+        Initial mass of each box, defaults to the model's steady state masses
+        (the k values are always derived from model.M0)
+    t0: float
+        Time of M0, defaults to t_eval[0]
+
+    Returns
+    -------
+    result: Result
+        t: the output times; edges and labels ('F21', ...) of the fluxes;
+        M: (n_boxes, n_t) masses; S: (n_edges, n_t) sensitivities (GtC per
+        GtC/yr) of the chosen box, or (n_edges, n_boxes, n_t) if box is None
+    """
+    if not getattr(model, 'is_linear', True):
+        raise ValueError("flux_sensitivity needs a model with a constant rate matrix")
+    t_eval = np.atleast_1d(np.asarray(t_eval, dtype = float))
+    t0 = t_eval[0] if t0 is None else t0
+    M0 = model.M0 if M0 is None else np.asarray(M0, dtype = float)
+    edges = flux_edges(model.F_in) if edges is None else [tuple(e) for e in edges]
+    n, p = model.n_boxes, len(edges)
+    k = model.dense_k()
+
+    # block lower triangular system for x = [M, S_1, ..., S_p]
+    K = np.zeros(((p+1)*n, (p+1)*n))
+    for q in range(p+1):
+        K[q*n:(q+1)*n, q*n:(q+1)*n] = k
+    for q, (i, j) in enumerate(edges, start = 1):
+        K[q*n + i, j] += 1. / model.M0[j]
+        K[q*n + j, j] -= 1. / model.M0[j]
+    b = np.zeros((p+1)*n)
+    b[model.forcing_box] = 1.
+    x0 = np.zeros((p+1)*n)
+    x0[:n] = M0
+
+    scenario = get_scenario(scenario)
+    x = _solve_affine(K, b, x0, t0, t_eval, scenario.t_yr, scenario.e_GtC_yr) # (n_t, (p+1)*n)
+    S = x[:, n:].reshape(len(t_eval), p, n).transpose(1, 2, 0) # (p, n, n_t)
+    if box is not None:
+        S = S[:, box, :]
+    return Result(t = t_eval, edges = edges, labels = [flux_label(i, j) for i, j in edges],
+                  M = x[:, :n].T, S = S)
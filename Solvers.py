@@ -0,0 +1,538 @@
+import numpy as np
+from Functions import Result, get_scenario
+
+## Solution engines for the linear box models in Functions.py. scipy is imported
+## inside the functions that use it, so importing this module stays cheap
+
+def _forcing_knots(scenario):
+    """Knots of the piecewise linear forcing for a scenario
+
+    Parameters
+    ----------
+    scenario: int, str or Functions.EmissionsScenario
+        The forcing scenario to use, see Functions.get_scenario
+
+    Returns
+    -------
+    t_yr: 1D array
+        Years of the knots
+    e_GtC_yr: 1D array
+        Emissions at each knot (GtC/yr)
+    """
+    scenario = get_scenario(scenario)
+    return scenario.t_yr, scenario.e_GtC_yr
+
+def _segment_slope(t, knot_t, knot_e):
+    """Slope of the piecewise linear forcing on the segment starting at t
+    (zero outside the knots, where np.interp holds the end values)"""
+    idx = np.searchsorted(knot_t, t, side = 'right')
+    if idx == 0 or idx == len(knot_t):
+        return 0.
+    return (knot_e[idx] - knot_e[idx-1]) / (knot_t[idx] - knot_t[idx-1])
+
+def _solve_affine(k, b, x0, t0, t_eval, knot_t, knot_e):
+    """Exact solution of dx/dt = k*x + e(t)*b for piecewise linear e(t)
+
+    The forcing value u = e(t) and its slope are appended to the state, so that
+    on each segment between knots the augmented system is autonomous and linear
+    and can be advanced exactly with one matrix exponential per distinct step.
+    This also works when k is singular, as it is for the mass-conserving models.
+
+    Parameters
+    ----------
+    k: MxM array, or SxMxM array for a batch of S systems
+        System matrix
+    b: M-length array
+        Vector the forcing is injected along
+    x0: M-length array, or SxM array
+        State at t0
+    t0: float
+        Initial time
+    t_eval: 1D array
+        Non-decreasing times (>= t0) to return the state at
+    knot_t, knot_e: 1D arrays
+        Knots of the piecewise linear forcing
+
+    Returns
+    -------
+    x: (..., len(t_eval), M) array
+        State at each time in t_eval
+    """
+    from scipy.linalg import expm
+
+    k = np.asarray(k, dtype = float)
+    m = k.shape[-1]
+    batch = k.shape[:-2]
+    x0 = np.broadcast_to(np.asarray(x0, dtype = float), batch + (m,))
+
+    # augmented matrix for z = [x, u, du/dt]
+    A = np.zeros(batch + (m+2, m+2))
+    A[..., :m, :m] = k
+    A[..., :m, m] = b
+    A[..., m, m+1] = 1.
+
+    z = np.empty(batch + (m+2,))
+    z[..., :m] = x0
+    z[..., m] = np.interp(t0, knot_t, knot_e)
+    z[..., m+1] = _segment_slope(t0, knot_t, knot_e)
+
+    # march through the requested times and the forcing knots in order
+    inner = knot_t[(knot_t > t0) & (knot_t < t_eval[-1])]
+    stops = np.union1d(t_eval, inner)
+    out = np.empty(batch + (len(t_eval), m))
+    propagators = {} # expm(A*dt) reused for repeated step sizes
+    t = t0
+    jj = 0
+    for stop in stops:
+        dt = stop - t
+        if dt > 0:
+            key = round(dt, 10)
+            if key not in propagators:
+                propagators[key] = expm(A*dt)
+            z = np.matmul(propagators[key], z[..., None])[..., 0]
+            t = stop
+        while jj < len(t_eval) and t_eval[jj] == stop:
+            out[..., jj, :] = z[..., :m]
+            jj += 1
+        if stop in inner: # reset forcing at the knot to the next segment
+            z[..., m] = np.interp(stop, knot_t, knot_e)
+            z[..., m+1] = _segment_slope(stop, knot_t, knot_e)
+    return out
+
+def _solve_affine_sparse(k, b, x0, t0, t_eval, knot_t, knot_e):
+    """_solve_affine for a large sparse k: the same augmented system, advanced
+    with the action of the matrix exponential (expm_multiply) so no dense
+    NxN matrix is ever formed. Not batched"""
+    from scipy import sparse
+    from scipy.sparse.linalg import expm_multiply
+
+    m = k.shape[0]
+    A = sparse.bmat([[k, sparse.csr_matrix(b.reshape(m, 1)), None],
+                     [None, None, sparse.csr_matrix([[1.]])],
+                     [sparse.csr_matrix((1, m)), None, sparse.csr_matrix((1, 1))]]).tocsr()
+
+    z = np.empty(m+2)
+    z[:m] = x0
+    z[m] = np.interp(t0, knot_t, knot_e)
+    z[m+1] = _segment_slope(t0, knot_t, knot_e)
+
+    inner = knot_t[(knot_t > t0) & (knot_t < t_eval[-1])]
+    stops = np.union1d(t_eval, inner)
+    out = np.empty((len(t_eval), m))
+    t = t0
+    jj = 0
+    for stop in stops:
+        if stop > t:
+            z = expm_multiply(A*(stop - t), z)
+            t = stop
+        while jj < len(t_eval) and t_eval[jj] == stop:
+            out[jj, :] = z[:m]
+            jj += 1
+        if stop in inner:
+            z[m] = np.interp(stop, knot_t, knot_e)
+            z[m+1] = _segment_slope(stop, knot_t, knot_e)
+    return out
+
+def solve_linear(model, t_eval, scenario = 1, M0 = None, t0 = None):
+    """Exact solution of the linear box model dM/dt = k*M + e(t) in the forcing
+    box for the piecewise linear emission scenarios, with no time stepping
+
+    Parameters
+    ----------
+    model: Functions.BoxModel
+        Box model with the precompiled rate matrix
+    t_eval: 1D array
+        Non-decreasing times (yr) to return the masses at
+    scenario: int, str or Functions.EmissionsScenario
+        The forcing scenario to use, see Functions.get_scenario
+    M0: N-length array
+        Initial mass of each box, defaults to the model's steady state masses
+    t0: float
+        Time of M0, defaults to t_eval[0]
+
+    Returns
+    -------
+    M: N x len(t_eval) array
+        Mass in each box at each time, laid out like solve_ivp's y
+    """
+    t_eval = np.atleast_1d(np.asarray(t_eval, dtype = float))
+    if t_eval.ndim != 1 or len(t_eval) == 0:
+        raise ValueError("t_eval must be a non-empty 1D array")
+    if np.any(np.diff(t_eval) < 0):
+        raise ValueError("t_eval must be non-decreasing")
+    if t0 is None:
+        t0 = t_eval[0]
+    if t_eval[0] < t0:
+        raise ValueError("t_eval must not start before t0")
+    if M0 is None:
+        M0 = model.M0
+    if not getattr(model, 'is_linear', True):
+        raise ValueError("solve_linear needs a model with a constant rate matrix, use run_model")
+
+    b = np.zeros(model.n_boxes)
+    b[model.forcing_box] = 1.
+    knot_t, knot_e = _forcing_knots(scenario)
+    if getattr(model, 'is_sparse', False):
+        return _solve_affine_sparse(model.k, b, M0, t0, t_eval, knot_t, knot_e).T
+    return _solve_affine(model.k, b, M0, t0, t_eval, knot_t, knot_e).T
+
+def integrate_batch(model, x0, xf, N, scenarios = (1,), M0 = None):
+    """Runge-Kutta integration to the 4th order of many forcing scenarios
+    and/or initial masses at once, with one k @ M product per stage for the
+    whole batch. Same fixed step semantics as Functions.rk4
+
+    Parameters
+    ----------
+    model: Functions.BoxModel
+        Box model with the precompiled rate matrix
+    x0: int OR float
+        Initial time
+    xf: int OR float
+        Final time
+    N: int
+        Number of intervals to use between x0 and xf
+    scenarios: sequence of int, str or Functions.EmissionsScenario
+        Forcing scenarios to use, see Functions.get_scenario
+    M0: N-length array or (n_scenarios, n_boxes) array
+        Initial masses, shared by all scenarios or one row per scenario;
+        defaults to the model's steady state masses. A single scenario is
+        broadcast over multiple rows of M0
+
+    Returns
+    -------
+    X: 1D numpy array
+        Values of the independent variable
+    Y: (n_scenarios, N+1, n_boxes) numpy array
+        Mass in each box at each time for each scenario
+    """
+    if not getattr(model, 'is_linear', True):
+        raise ValueError("integrate_batch needs a model with a constant rate matrix, use run_model")
+    if N < 2:
+        N = 2 #set minimum number for N
+    h = (xf - x0) / N
+    if M0 is None:
+        M0 = model.M0
+    M0 = np.atleast_2d(np.asarray(M0, dtype = float))
+    scenarios = list(scenarios)
+    S = max(len(scenarios), M0.shape[0])
+    if len(scenarios) == 1:
+        scenarios = scenarios * S
+    if len(scenarios) != S or M0.shape[0] not in (1, S):
+        raise ValueError("scenarios and rows of M0 must have matching lengths")
+
+    # forcing of every scenario at all full and half step times, evaluated up front
+    X = x0 + h*np.arange(N+1)
+    t_half = x0 + (h/2)*np.arange(2*N+1)
+    E = np.empty((S, 2*N+1))
+    for ii, a in enumerate(scenarios):
+        E[ii] = get_scenario(a)(t_half)
+
+    k = model.k
+    kT = None if getattr(model, 'is_sparse', False) else np.ascontiguousarray(k.T)
+    fb = model.forcing_box
+    Y = np.empty((S, N+1, model.n_boxes))
+    Y[:, 0, :] = M0
+    y = Y[:, 0, :].copy()
+    k1, k2, k3, k4, tmp = (np.empty_like(y) for _ in range(5))
+
+    def f(M, e, out):
+        if kT is None:
+            out[:] = (k @ M.T).T
+        else:
+            np.matmul(M, kT, out = out)
+        out[:, fb] += e
+        out *= h
+
+    for ii in range(N):
+        f(y, E[:, 2*ii], k1)
+        np.multiply(k1, 0.5, out = tmp); tmp += y
+        f(tmp, E[:, 2*ii+1], k2)
+        np.multiply(k2, 0.5, out = tmp); tmp += y
+        f(tmp, E[:, 2*ii+1], k3)
+        np.add(y, k3, out = tmp)
+        f(tmp, E[:, 2*ii+2], k4)
+
+        k2 += k3; k2 *= 2.; k1 += k2; k1 += k4
+        k1 /= 6.
+        y += k1
+        Y[:, ii+1, :] = y
+
+    return X, Y
+
+## solve_ivp methods that use a Jacobian
+implicit_methods = ('Radau', 'BDF', 'LSODA')
+
+def _dense_jac(jac):
+    """jac(t, M, a) returning dense arrays, for LSODA, which cannot take the
+    CSR matrices of sparse models"""
+    def dense(t, M, a = 0):
+        J = jac(t, M, a)
+        return J.toarray() if hasattr(J, 'toarray') else J
+    return dense
+
+def run_model(model, t_span, scenario = 1, method = 'RK45', t_eval = None, dense_output = False,
+              breakpoints = True, M0 = None, **options):
+    """Integrates a box model with solve_ivp, restarting the adaptive solver at
+    the emission knots so it can take large steps between the kinks in the
+    forcing while staying accurate at them, instead of using a tiny max_step
+
+    Parameters
+    ----------
+    model: Functions.BoxModel or FluxLaws.NonlinearBoxModel
+        Box model to integrate (anything with rhs(t, M, a), jac, n_boxes and M0)
+    t_span: 2-tuple of floats
+        Interval of integration (yr)
+    scenario: int, str or Functions.EmissionsScenario
+        The forcing scenario to use, see Functions.get_scenario
+    method: str
+        solve_ivp integration method, e.g. 'RK45', 'DOP853'; the implicit
+        methods (Radau, BDF, LSODA) are given the model's constant Jacobian
+    t_eval: 1D array
+        Times to store the solution at; by default every solver step is kept
+    dense_output: bool
+        Whether to return a continuous solution (sol) over the whole t_span
+    breakpoints: bool
+        Whether to stop and restart the solver at the emission knots (and
+        at the knots of the model's flux schedules, if it has any)
+    M0: N-length array
+        Initial mass of each box, defaults to the model's steady state masses
+    **options
+        Passed on to solve_ivp (rtol, atol, max_step, vectorized, ...)
+
+    Returns
+    -------
+    result: Result
+        With the same fields as solve_ivp's result: t, y, sol, nfev, njev,
+        nlu, status, message and success
+    """
+    from scipy.integrate import solve_ivp, OdeSolution
+
+    t0, tf = float(t_span[0]), float(t_span[1])
+    if tf <= t0:
+        raise ValueError("t_span must be increasing")
+    if method in implicit_methods and 'jac' not in options:
+        # the linear model's Jacobian is constant, so the implicit methods never
+        # have to estimate it by finite differences; the nonlinear models need
+        # a callable, and so does LSODA, which only takes dense arrays
+        if not getattr(model, 'is_linear', True):
+            options['jac'] = _dense_jac(model.jac) if method == 'LSODA' else model.jac
+        elif method == 'LSODA':
+            J = model.jacobian()
+            options['jac'] = lambda t, M, a = 0: J
+        else:
+            options['jac'] = model.jacobian(sparse = model.n_boxes > 50)
+    scenario = get_scenario(scenario)
+    y = model.M0 if M0 is None else np.asarray(M0, dtype = float)
+    if t_eval is not None:
+        t_eval = np.asarray(t_eval, dtype = float)
+        if np.any(np.diff(t_eval) < 0) or (len(t_eval) and (t_eval[0] < t0 or t_eval[-1] > tf)):
+            raise ValueError("t_eval must be increasing and within t_span")
+
+    # segment edges: the emission knots, and those of any flux schedules
+    # (Schedules.ScheduledBoxModel), strictly inside t_span
+    edges = [t0, tf]
+    if breakpoints:
+        knots = ([] if scenario.is_zero else [scenario.t_yr]) + [np.asarray(getattr(model, 'knots', []), dtype = float)]
+        knots = np.unique(np.concatenate(knots))
+        edges = [t0] + list(knots[(knots > t0) & (knots < tf)]) + [tf]
+
+    ts, ys, interpolants, sol_ts = [], [], [], [t0]
+    nfev = njev = nlu = 0
+    for ii, (a, b) in enumerate(zip(edges[:-1], edges[1:])):
+        last = ii == len(edges) - 2
+        seg_eval = None
+        if t_eval is not None:
+            mask = (t_eval >= a) & ((t_eval <= b) if last else (t_eval < b))
+            seg_eval = t_eval[mask]
+            if b not in seg_eval: # always keep the segment end to restart from
+                seg_eval = np.append(seg_eval, b)
+        res = solve_ivp(model.rhs, (a, b), y, method = method, t_eval = seg_eval,
+                        dense_output = dense_output, args = (scenario,), **options)
+        nfev += res.nfev; njev += res.njev; nlu += res.nlu
+        if res.status < 0:
+            return Result(t = np.concatenate(ts) if ts else np.empty(0),
+                          y = np.hstack(ys) if ys else np.empty((model.n_boxes, 0)),
+                          sol = None, nfev = nfev, njev = njev, nlu = nlu,
+                          status = res.status, message = res.message, success = False)
+        y = res.y[:, -1]
+        t_seg, y_seg = res.t, res.y
+        if t_eval is not None:
+            keep = np.isin(t_seg, t_eval[mask])
+            t_seg, y_seg = t_seg[keep], y_seg[:, keep]
+        elif ii > 0: # first point repeats the previous segment end
+            t_seg, y_seg = t_seg[1:], y_seg[:, 1:]
+        ts.append(t_seg); ys.append(y_seg)
+        if dense_output:
+            interpolants.extend(res.sol.interpolants)
+            sol_ts.extend(res.sol.ts[1:])
+
+    sol = OdeSolution(sol_ts, interpolants) if dense_output else None
+    return Result(t = np.concatenate(ts), y = np.hstack(ys), sol = sol,
+                  nfev = nfev, njev = njev, nlu = nlu, status = 0,
+                  message = 'The solver successfully reached the end of the integration interval.',
+                  success = True)
+
+def iter_chunks(model, t_span, dt, scenario = 1, method = 'exact', chunk_years = 100., M0 = None,
+                substeps = 1, **options):
+    """Integrates a box model chunk by chunk, yielding the masses on a regular
+    output grid a fixed number of years at a time, so only one chunk is ever
+    in memory however long the run
+
+    Parameters
+    ----------
+    model: Functions.BoxModel or FluxLaws.NonlinearBoxModel
+        Box model to integrate
+    t_span: 2-tuple of floats
+        Interval of integration (yr)
+    dt: float
+        Output interval (yr), the masses are returned at t0, t0+dt, ... up to tf
+    scenario: int, str or Functions.EmissionsScenario
+        The forcing scenario to use, see Functions.get_scenario
+    method: str
+        'exact' (solve_linear), 'rk4' (integrate_batch, substeps fixed steps per
+        output interval) or a solve_ivp method (run_model)
+    chunk_years: float
+        Length of each chunk (yr), rounded to a whole number of output intervals
+    M0: N-length array
+        Initial mass of each box, defaults to the model's steady state masses
+    substeps: int
+        rk4 steps per output interval
+    **options
+        Passed on to run_model (rtol, atol, ...)
+
+    Yields
+    ------
+    t: 1D array
+        Output times of the chunk
+    y: N x len(t) array
+        Mass in each box at those times
+    """
+    t0, tf = float(t_span[0]), float(t_span[1])
+    if tf < t0 or dt <= 0:
+        raise ValueError("t_span must be non-decreasing and dt positive")
+    n_out = int(np.floor((tf - t0)/dt + 1e-9)) + 1
+    per_chunk = max(1, int(round(chunk_years/dt)))
+    y = model.M0 if M0 is None else np.asarray(M0, dtype = float)
+    t_prev = t0
+    for k0 in range(0, n_out, per_chunk):
+        idx = np.arange(k0, min(k0 + per_chunk, n_out))
+        t = t0 + dt*idx # from the index, so long runs do not drift
+        if t[-1] == t_prev: # the first output point is the initial state
+            y_chunk = y.reshape(-1, 1).copy()
+        elif method == 'exact':
+            y_chunk = solve_linear(model, t, scenario, M0 = y, t0 = t_prev)
+        elif method == 'rk4':
+            n = int(round((t[-1] - t_prev)/dt))
+            N = max(substeps*n, 2)
+            X, Y = integrate_batch(model, t_prev, t[-1], N, [scenario], M0 = y)
+            start = 0 if t[0] == t_prev else N//n
+            y_chunk = Y[0, start::N//n, :].T.copy()
+        else:
+            res = run_model(model, (t_prev, t[-1]), scenario, method = method, t_eval = t, M0 = y, **options)
+            if not res.success:
+                raise RuntimeError("%s failed at t = %g: %s" % (method, res.t[-1] if len(res.t) else t_prev, res.message))
+            y_chunk = res.y
+        y, t_prev = y_chunk[:, -1], t[-1]
+        yield t, y_chunk
+
+## reductions over output windows, applied with ufunc.reduceat
+_reducers = {'mean': np.add, 'min': np.minimum, 'max': np.maximum}
+
+def reduce_windows(t, y, samples, how = 'mean'):
+    """Reduces every window of samples consecutive output points to one value,
+    e.g. annual means of monthly output. A shorter last window is reduced over
+    the points it has
+
+    Parameters
+    ----------
+    t: 1D array
+        Output times
+    y: N x len(t) array
+        Masses at those times
+    samples: int
+        Output points per window
+    how: str
+        'mean', 'min' or 'max'
+
+    Returns
+    -------
+    t_win: 1D array
+        Start time of each window
+    y_win: N x len(t_win) array
+        Reduced masses
+    """
+    if how not in _reducers:
+        raise ValueError("Unknown reduction '%s', expected one of %s" % (how, sorted(_reducers)))
+    starts = np.arange(0, len(t), samples)
+    y_win = _reducers[how].reduceat(y, starts, axis = 1)
+    if how == 'mean':
+        y_win /= np.diff(np.append(starts, len(t)))
+    return t[starts], y_win
+
+def stream_run(model, t_span, dt, scenario = 1, method = 'exact', out = None, reduce = None, period = 1.,
+               chunk_years = 100., M0 = None, **options):
+    """Runs a box model in chunks (see iter_chunks), optionally reducing the
+    output over windows of period years as it goes, and writes the result
+    incrementally to memory mapped .npy files so long, finely resolved runs
+    use constant memory
+
+    Parameters
+    ----------
+    model, t_span, dt, scenario, method, chunk_years, M0, **options
+        As for iter_chunks
+    out: str
+        Directory for the output files (t.npy plus y.npy, or one file per
+        reduction, e.g. mean.npy); None to keep the result in memory
+    reduce: str or sequence of str
+        Reductions over each window, 'mean', 'min' and/or 'max'; None to keep
+        every output point
+    period: float
+        Window length (yr), a whole number of output intervals
+
+    Returns
+    -------
+    result: Result
+        t (window start times with reduce) and y, or one N x len(t) array per
+        reduction named after it; memory mapped read-only from out if given
+    """
+    import os
+
+    t0, tf = float(t_span[0]), float(t_span[1])
+    n_out = int(np.floor((tf - t0)/dt + 1e-9)) + 1
+    names = ['y'] if reduce is None else [reduce] if isinstance(reduce, str) else list(reduce)
+    for name in names:
+        if name != 'y' and name not in _reducers:
+            raise ValueError("Unknown reduction '%s', expected one of %s" % (name, sorted(_reducers)))
+    samples = 1
+    if reduce is not None:
+        samples = int(round(period/dt))
+        if samples < 1 or abs(samples*dt - period) > 1e-9*period:
+            raise ValueError("period must be a whole number of output intervals dt")
+        # whole windows per chunk, so no window straddles two chunks
+        chunk_years = samples*dt*max(1, int(round(chunk_years/(samples*dt))))
+    n_rows = -(-n_out // samples)
+
+    if out is None:
+        alloc = lambda name, shape: np.empty(shape)
+    else:
+        os.makedirs(out, exist_ok = True)
+        alloc = lambda name, shape: np.lib.format.open_memmap(os.path.join(out, name + '.npy'), mode = 'w+',
+                                                              dtype = float, shape = shape)
+    arrays = {'t': alloc('t', (n_rows,))}
+    for name in names:
+        arrays[name] = alloc(name, (model.n_boxes, n_rows))
+
+    row = 0
+    for t, y in iter_chunks(model, t_span, dt, scenario, method, chunk_years, M0, **options):
+        for name in names:
+            t_win, y_win = (t, y) if name == 'y' else reduce_windows(t, y, samples, name)
+            arrays[name][:, row:row + len(t_win)] = y_win
+        arrays['t'][row:row + len(t_win)] = t_win
+        row += len(t_win)
+
+    if out is None:
+        return Result(arrays)
+    for arr in arrays.values():
+        arr.flush()
+    del arrays
+    return Result({name: np.load(os.path.join(out, name + '.npy'), mmap_mode = 'r') for name in ['t'] + names})
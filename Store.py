@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+## On-disk store of solve results, one compressed NPZ file per configuration,
+## keyed by a hash of everything that determines the result
+
+def model_fingerprint(model):
+    """Hash of the parts of a box model that determine its solution (rate
+    matrix, initial masses, forcing box, and the flux laws of a
+    FluxLaws.NonlinearBoxModel or the flux schedules of a
+    Schedules.ScheduledBoxModel), so editing a flux in Initialize.py
+    invalidates stored results
+
+    Returns
+    -------
+    fingerprint: str
+        Hex digest
+    """
+    h = hashlib.sha256()
+    # a NonlinearBoxModel has only its linear edges in a rate matrix
+    k = model.k_lin if hasattr(model, 'laws') else model.k
+    if hasattr(k, 'tocsr'):
+        k = k.tocsr()
+        for arr in (k.data, k.indices, k.indptr):
+            h.update(np.ascontiguousarray(arr).tobytes())
+    else:
+        h.update(np.ascontiguousarray(k, dtype = float).tobytes())
+    h.update(np.ascontiguousarray(model.M0, dtype = float).tobytes())
+    # flux laws of a FluxLaws.NonlinearBoxModel, with their parameters
+    if hasattr(model, 'laws'):
+        laws = sorted((i, j, law) for (i, j), law in model.laws.items() if law != 'linear')
+        h.update(str(laws).encode())
+        edges = [(i, j) for i, j, _ in laws]
+        param = dict(zip(zip(model.dst.tolist(), model.src.tolist()), model.param.tolist()))
+        h.update(np.array([param[e] for e in edges] + [model.F_in[e] for e in edges], dtype = float).tobytes())
+    # flux schedules of a Schedules.ScheduledBoxModel
+    for arr in getattr(model, 'schedule_arrays', ()):
+        h.update(np.ascontiguousarray(arr, dtype = float).tobytes())
+    h.update(str((model.n_boxes, model.forcing_box)).encode())
+    return h.hexdigest()
+
+def config_key(config):
+    """Hash of a JSON-serializable configuration dict (key order does not matter)
+
+    Returns
+    -------
+    key: str
+        Hex digest
+    """
+    text = json.dumps(config, sort_keys = True, default = _jsonable)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def _jsonable(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError("Object of type %s is not JSON serializable" % type(obj).__name__)
+
+class ResultStore:
+    """Directory of compressed NPZ result files named by configuration key
+
+    Parameters
+    ----------
+    root: str
+        Directory of the store, created when the first result is written
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        """File holding the result for a key (two-character fan-out directories)"""
+        return os.path.join(self.root, key[:2], key + '.npz')
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def get(self, key):
+        """Stored arrays for a key, or None if the configuration was never run
+
+        Returns
+        -------
+        arrays: dict of str -> array
+            The arrays given to put, plus 'config', the configuration dict
+        """
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        with np.load(path, allow_pickle = False) as f:
+            arrays = {name: f[name] for name in f.files}
+        arrays['config'] = json.loads(str(arrays['config']))
+        return arrays
+
+    def put(self, key, config, **arrays):
+        """Writes arrays for a key, atomically so readers never see a partial file
+
+        Returns
+        -------
+        path: str
+            File the result was written to
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        tmp = path + '.%d.tmp' % os.getpid()
+        with open(tmp, 'wb') as f:
+            np.savez_compressed(f, config = json.dumps(config, sort_keys = True, default = _jsonable), **arrays)
+        os.replace(tmp, path)
+        return path
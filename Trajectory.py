@@ -0,0 +1,177 @@
+import json
+import numpy as np
+from Initialize import PPM_TO_GTC
+
+## Compact container for a box model run: times and masses in one contiguous
+## (1 + n_boxes, n_t) buffer, row 0 the times and row 1+i box i, so every box
+## is a contiguous row that is handed out as a view rather than a copy
+
+## mass units and their size in GtC; ppm is a concentration, only defined for
+## the atmosphere (the forcing box)
+units = {'GtC': 1., 'ppm': PPM_TO_GTC}
+
+class Trajectory:
+    """Times and box masses of one run in a single buffer
+
+    Parameters
+    ----------
+    t: 1D array
+        Times (yr)
+    y: N x len(t) array
+        Mass in each box (GtC), laid out like solve_ivp's y
+    box_names: list of str
+        Names of the boxes, defaults to 'box1', 'box2', ...
+    dtype: numpy dtype
+        Storage type, np.float32 halves the memory (times then keep about 7
+        significant digits, ~1e-3 yr at year 10000)
+    unit: str
+        Unit the masses are returned in, a key of Trajectory.units; the
+        buffer always holds GtC and the conversion is done on access. In ppm
+        only the atmosphere (forcing_box) can be read
+    forcing_box: int
+        Index of the atmosphere box
+    """
+    units = units
+
+    def __init__(self, t, y, box_names = None, dtype = float, unit = 'GtC', forcing_box = 0):
+        t = np.asarray(t)
+        y = np.asarray(y)
+        if np.iscomplexobj(y):
+            if np.abs(y.imag).max(initial = 0.) > 1e-9 * np.abs(y.real).max(initial = 1.):
+                raise ValueError("Trajectory masses must be real")
+            y = y.real
+        if y.ndim != 2 or y.shape[1] != len(t):
+            raise ValueError("y must be an N x len(t) array, got shape %s for %d times" % (y.shape, len(t)))
+        data = np.empty((1 + y.shape[0], len(t)), dtype = dtype)
+        data[0] = t
+        data[1:] = y
+        self._init(data, box_names, unit, forcing_box)
+
+    def _init(self, data, box_names, unit, forcing_box = 0):
+        if unit not in units:
+            raise ValueError("Unknown unit '%s', expected one of %s" % (unit, sorted(units)))
+        self.data = data
+        self.n_boxes = data.shape[0] - 1
+        self.box_names = ['box%d' % (i+1) for i in range(self.n_boxes)] if box_names is None else list(box_names)
+        if len(self.box_names) != self.n_boxes:
+            raise ValueError("Expected %d box names, got %d" % (self.n_boxes, len(self.box_names)))
+        if not 0 <= forcing_box < self.n_boxes:
+            raise ValueError("forcing_box %d out of range for %d boxes" % (forcing_box, self.n_boxes))
+        self.unit = unit
+        self.forcing_box = forcing_box
+        self._index = {name: i for i, name in enumerate(self.box_names)}
+
+    @classmethod
+    def from_buffer(cls, data, box_names = None, unit = 'GtC', forcing_box = 0):
+        """Trajectory around an existing (1 + n_boxes, n_t) buffer (e.g. a
+        memory map), without copying it"""
+        traj = cls.__new__(cls)
+        traj._init(data, box_names, unit, forcing_box)
+        return traj
+
+    @classmethod
+    def from_result(cls, res, model = None, dtype = float):
+        """Trajectory of a run_model/solve_ivp result (t, y), named after the
+        model's boxes"""
+        return cls(res.t, res.y, getattr(model, 'box_names', None), dtype,
+                   forcing_box = getattr(model, 'forcing_box', 0))
+
+    @classmethod
+    def from_rk4(cls, X, Y, model = None, dtype = float):
+        """Trajectory of the (X, Y) output of rk4 or rk45 (rows are times)"""
+        return cls(np.ravel(X), np.asarray(Y).T, getattr(model, 'box_names', None), dtype,
+                   forcing_box = getattr(model, 'forcing_box', 0))
+
+    def __len__(self):
+        return self.data.shape[1]
+
+    def __repr__(self):
+        return "Trajectory(%d boxes, %d times %g..%g, %s, %s)" % (
+            self.n_boxes, len(self), self.data[0, 0] if len(self) else np.nan,
+            self.data[0, -1] if len(self) else np.nan, self.data.dtype, self.unit)
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    @property
+    def t(self):
+        """Times (view of the buffer)"""
+        return self.data[0]
+
+    @property
+    def y(self):
+        """N x n_t masses in the current unit; a view of the buffer in GtC"""
+        if units[self.unit] != 1.:
+            raise ValueError("Only the atmosphere can be read in %s, use box()" % self.unit)
+        return self.data[1:]
+
+    def _convert(self, arr, i):
+        scale = units[self.unit]
+        if scale == 1.:
+            return arr
+        if i != self.forcing_box:
+            raise ValueError("Box '%s' cannot be read in %s, only the atmosphere ('%s')"
+                             % (self.box_names[i], self.unit, self.box_names[self.forcing_box]))
+        return arr / scale
+
+    def box(self, key):
+        """Masses of one box by name or index; a view of the buffer in GtC"""
+        i = self._index[key] if isinstance(key, str) else int(key)
+        if not -self.n_boxes <= i < self.n_boxes:
+            raise IndexError("Box index %d out of range for %d boxes" % (i, self.n_boxes))
+        i %= self.n_boxes
+        return self._convert(self.data[1 + i], i)
+
+    def __getitem__(self, key):
+        if isinstance(key, (str, int, np.integer)):
+            return self.box(key)
+        raise TypeError("Trajectory boxes are indexed by name or int, use .y or .data to slice")
+
+    def __getattr__(self, name):
+        # boxes as attributes, spaces and dashes written as underscores: traj.surface_water
+        index = self.__dict__.get('_index', {})
+        for box in index:
+            if box.replace(' ', '_').replace('-', '_') == name:
+                return self.box(box)
+        raise AttributeError("'Trajectory' object has no attribute or box '%s'" % name)
+
+    def __dir__(self):
+        return list(super().__dir__()) + [b.replace(' ', '_').replace('-', '_') for b in self.box_names]
+
+    def to(self, unit):
+        """The same trajectory with masses returned in another unit; shares
+        the buffer, nothing is converted until a box is read ('ppm' only for
+        the atmosphere)"""
+        return Trajectory.from_buffer(self.data, self.box_names, unit, self.forcing_box)
+
+    def astype(self, dtype):
+        """Copy stored in another dtype, e.g. np.float32"""
+        return Trajectory.from_buffer(self.data.astype(dtype), self.box_names, self.unit, self.forcing_box)
+
+    def save(self, path):
+        """Writes the buffer to path ('.npy' appended if missing) and the box
+        names, unit and forcing box to a .json file next to it, for load"""
+        base = path[:-4] if path.endswith('.npy') else path
+        np.save(base + '.npy', self.data)
+        with open(base + '.json', 'w') as f:
+            json.dump({'box_names': self.box_names, 'unit': self.unit, 'forcing_box': self.forcing_box}, f)
+        return base + '.npy'
+
+    @classmethod
+    def load(cls, path, mmap = True):
+        """Reads a trajectory written by save, memory mapped read-only by
+        default so opening it is instant whatever its size"""
+        base = path[:-4] if path.endswith('.npy') else path
+        data = np.load(base + '.npy', mmap_mode = 'r' if mmap else None)
+        with open(base + '.json') as f:
+            meta = json.load(f)
+        return cls.from_buffer(data, meta['box_names'], meta['unit'], meta.get('forcing_box', 0))
+
+    def __getstate__(self):
+        # memory maps are pickled as plain arrays
+        return {'data': np.asarray(self.data), 'box_names': self.box_names, 'unit': self.unit,
+                'forcing_box': self.forcing_box}
+
+    def __setstate__(self, state):
+        self._init(state['data'], state['box_names'], state['unit'], state.get('forcing_box', 0))
@@ -0,0 +1,266 @@
+'''
+Solver benchmarks for the box models.
+
+    python benchmark.py                          # full suite, writes benchmark_report.json
+    python benchmark.py --quick                  # A2 only, one accuracy level
+    python benchmark.py --baseline old.json      # also flag regressions against an older report
+    python benchmark.py --stiff                  # explicit vs implicit crossover on long runs
+
+The suite times every integrator (the in-house rk4 and rk45, the scipy solve_ivp
+methods and the exact linear solver) on the 4- and 9-box models for each
+emission scenario at several accuracy levels, and records wall time, RHS
+evaluations, peak memory and the error against the exact solution.
+'''
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+from Functions import BoxModel, get_scenario, rk4, rk45, scenarios
+from Solvers import run_model, solve_linear
+
+# CONSTANTS
+yr_START = 1800
+yr_END = 2200
+RUN_ENDS = [2000, 2200, 3000, 5000, 10000] # end years, up to the end of the emissions table
+METHODS = ['RK45', 'Radau', 'BDF', 'LSODA']
+SUITE_METHODS = ['exact', 'rk4', 'rk45', 'RK45', 'RK23', 'DOP853', 'Radau', 'BDF', 'LSODA']
+TOLERANCES = [1e-3, 1e-6, 1e-9] # rtol of rk45 and the solve_ivp methods (atol = rtol*1 GtC)
+RK4_STEPS = [4000, 16000, 64000] # rk4 intervals matching the accuracy levels
+
+
+def stiff_crossover(model_name = '9box', scenario = 1, run_ends = RUN_ENDS, methods = METHODS,
+                    rtol = 1e-6, atol = 1e-6, n_eval = 401):
+    """Times the explicit and implicit solve_ivp methods on increasingly long
+    runs, to show where the stiff solvers overtake RK45
+
+    Parameters
+    ----------
+    model_name: str
+        Box model configuration, '4box' or '9box'
+    scenario: int, str or Functions.EmissionsScenario
+        The forcing scenario to use
+    run_ends: list of floats
+        Final years of the runs, all starting at yr_START
+    methods: list of str
+        solve_ivp methods to compare
+    rtol, atol: float
+        Solver tolerances
+    n_eval: int
+        Number of output times per run
+
+    Returns
+    -------
+    rows: list of dicts
+        One row per (run end, method) with wall time (s), RHS and Jacobian
+        evaluation counts and max relative error against solve_linear
+    """
+    model = BoxModel.from_config(model_name)
+    rows = []
+    for t_end in run_ends:
+        t_eval = np.linspace(yr_START, t_end, n_eval)
+        exact = solve_linear(model, t_eval, scenario)
+        scale = np.abs(exact).max()
+        for method in methods:
+            start = time.perf_counter()
+            res = run_model(model, (yr_START, t_end), scenario, method = method, t_eval = t_eval,
+                            rtol = rtol, atol = atol)
+            wall = time.perf_counter() - start
+            rows.append({'t_end': t_end, 'method': method, 'wall_s': wall, 'nfev': int(res.nfev),
+                         'njev': int(res.njev), 'rel_err': float(np.abs(res.y - exact).max() / scale)})
+    return rows
+
+
+class _CountingRHS:
+    """Wraps model.rhs to count evaluations"""
+    def __init__(self, model):
+        self.model = model
+        self.n_boxes, self.M0, self.forcing_box = model.n_boxes, model.M0, model.forcing_box
+        self.is_linear = model.is_linear
+        self.calls = 0
+
+    def rhs(self, t, M, a = 0):
+        self.calls += 1
+        return self.model.rhs(t, M, a)
+
+    def jac(self, t, M, a = 0):
+        return self.model.jac(t, M, a)
+
+    def jacobian(self, sparse = False):
+        return self.model.jacobian(sparse)
+
+
+def _solve(model, method, level, scenario, t_eval):
+    """One solve at an accuracy level, returns masses at t_eval and RHS evaluations"""
+    if method == 'exact':
+        return solve_linear(model, t_eval, scenario), 0
+    counted = _CountingRHS(model)
+    if method == 'rk4':
+        X, Y = rk4(lambda x, y: counted.rhs(x, y, scenario), t_eval[0], t_eval[-1], model.M0, RK4_STEPS[level])
+        y = np.array([np.interp(t_eval, X[:, 0], Y[:, i]) for i in range(model.n_boxes)])
+        return y, counted.calls
+    rtol = TOLERANCES[level]
+    if method == 'rk45':
+        X, Y = rk45(lambda x, y: counted.rhs(x, y, scenario), t_eval[0], t_eval[-1], model.M0, rtol = rtol,
+                    atol = rtol, x_eval = t_eval, breakpoints = get_scenario(scenario).t_yr)
+        return Y.T, counted.calls
+    res = run_model(counted, (t_eval[0], t_eval[-1]), scenario, method = method, t_eval = t_eval,
+                    rtol = rtol, atol = rtol)
+    if not res.success:
+        raise RuntimeError(res.message)
+    return res.y, counted.calls
+
+
+def benchmark_suite(model_names = ('4box', '9box'), scenario_names = None, methods = SUITE_METHODS,
+                    levels = (0, 1, 2), n_eval = 401, repeats = 1):
+    """Times each integrator on each model and scenario at each accuracy level
+
+    Parameters
+    ----------
+    model_names: sequence of str
+        Box model configurations
+    scenario_names: sequence of str
+        Emission scenarios, defaults to all registered ones
+    methods: sequence of str
+        'exact', 'rk4', 'rk45' and/or solve_ivp methods
+    levels: sequence of int
+        Accuracy levels, indices into TOLERANCES and RK4_STEPS ('exact' runs once)
+    n_eval: int
+        Output times between yr_START and yr_END, the error is measured on them
+    repeats: int
+        Timing repeats, the fastest is kept
+
+    Returns
+    -------
+    rows: list of dicts
+        model, scenario, method, level, rtol/steps, wall_s, nfev, peak_kb and
+        max_rel_err (max abs error over all boxes and times / max mass)
+    """
+    scenario_names = list(scenarios) if scenario_names is None else scenario_names
+    t_eval = np.linspace(yr_START, yr_END, n_eval)
+    rows = []
+    for model_name in model_names:
+        model = BoxModel.from_config(model_name)
+        for scenario in scenario_names:
+            reference = solve_linear(model, t_eval, scenario)
+            scale = np.abs(reference).max()
+            for method in methods:
+                for level in ([0] if method == 'exact' else levels):
+                    wall = np.inf
+                    for _ in range(repeats):
+                        start = time.perf_counter()
+                        y, nfev = _solve(model, method, level, scenario, t_eval)
+                        wall = min(wall, time.perf_counter() - start)
+                    # peak memory in a separate run, tracemalloc slows the timed ones down
+                    tracemalloc.start()
+                    _solve(model, method, level, scenario, t_eval)
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                    rows.append({'model': model_name, 'scenario': scenario, 'method': method, 'level': level,
+                                 'setting': '-' if method == 'exact' else
+                                            ('N=%d' % RK4_STEPS[level] if method == 'rk4' else 'rtol=%g' % TOLERANCES[level]),
+                                 'wall_s': wall, 'nfev': int(nfev), 'peak_kb': peak / 1024.,
+                                 'max_rel_err': float(np.abs(y - reference).max() / scale)})
+    return rows
+
+
+def find_regressions(rows, baseline, slowdown = 1.5, err_growth = 10.):
+    """Compares a suite run with an older report
+
+    Parameters
+    ----------
+    rows: list of dicts
+        Rows of the new run
+    baseline: list of dicts
+        Rows of the older report
+    slowdown: float
+        Wall time ratio above which a run counts as slower
+    err_growth: float
+        Error ratio above which a run counts as less accurate
+
+    Returns
+    -------
+    regressions: list of str
+        One description per regressed (model, scenario, method, level)
+    """
+    old = {(r['model'], r['scenario'], r['method'], r['level']): r for r in baseline}
+    out = []
+    for r in rows:
+        o = old.get((r['model'], r['scenario'], r['method'], r['level']))
+        if o is None:
+            continue
+        name = '%s/%s/%s/%s' % (r['model'], r['scenario'], r['method'], r['setting'])
+        if r['wall_s'] > slowdown * o['wall_s'] and r['wall_s'] - o['wall_s'] > 5e-3: # ignore timer noise on tiny runs
+            out.append('%s: wall time %.3g s -> %.3g s' % (name, o['wall_s'], r['wall_s']))
+        if r['max_rel_err'] > err_growth * max(o['max_rel_err'], 1e-14):
+            out.append('%s: error %.3g -> %.3g' % (name, o['max_rel_err'], r['max_rel_err']))
+    return out
+
+
+def work_precision_table(rows):
+    """Work-precision table: per model and method, median wall time, RHS
+    evaluations and error over the scenarios at each accuracy level"""
+    table = []
+    keys = sorted({(r['model'], r['method'], r['level'], r['setting']) for r in rows},
+                  key = lambda k: (k[0], SUITE_METHODS.index(k[1]) if k[1] in SUITE_METHODS else 99, k[2]))
+    for model, method, level, setting in keys:
+        sel = [r for r in rows if (r['model'], r['method'], r['level']) == (model, method, level)]
+        table.append({'model': model, 'method': method, 'setting': setting,
+                      'wall_s': float(np.median([r['wall_s'] for r in sel])),
+                      'nfev': int(np.median([r['nfev'] for r in sel])),
+                      'peak_kb': float(np.max([r['peak_kb'] for r in sel])),
+                      'max_rel_err': float(np.max([r['max_rel_err'] for r in sel]))})
+    return table
+
+
+def format_table(rows, columns):
+    """Formats a list of dicts as a plain text table"""
+    widths = [max(len(col), *(len(_fmt(row[col])) for row in rows)) for col in columns]
+    lines = ['  '.join(col.rjust(w) for col, w in zip(columns, widths))]
+    lines += ['  '.join(_fmt(row[col]).rjust(w) for col, w in zip(columns, widths)) for row in rows]
+    return '\n'.join(lines)
+
+
+def _fmt(val):
+    return '%.3g' % val if isinstance(val, float) else str(val)
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Box model solver benchmarks')
+    parser.add_argument('--quick', action = 'store_true', help = 'A2 scenario and the middle accuracy level only')
+    parser.add_argument('--out', default = 'benchmark_report.json', help = 'JSON report (default benchmark_report.json)')
+    parser.add_argument('--baseline', help = 'older JSON report to check for regressions')
+    parser.add_argument('--repeats', type = int, default = 1)
+    parser.add_argument('--stiff', action = 'store_true', help = 'run the explicit/implicit crossover benchmark instead')
+    args = parser.parse_args(argv)
+
+    if args.stiff:
+        rows = stiff_crossover()
+        print(format_table(rows, ['t_end', 'method', 'wall_s', 'nfev', 'njev', 'rel_err']))
+        return 0
+
+    kwargs = {'scenario_names': ['A2'], 'levels': (1,)} if args.quick else {}
+    rows = benchmark_suite(repeats = args.repeats, **kwargs)
+    table = work_precision_table(rows)
+    print(format_table(table, ['model', 'method', 'setting', 'wall_s', 'nfev', 'peak_kb', 'max_rel_err']))
+
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+              'numpy': np.__version__, 'machine': platform.machine(), 'runs': rows, 'work_precision': table}
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent = 1)
+    print('report written to %s' % args.out)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(rows, json.load(f)['runs'])
+        for line in regressions:
+            print('REGRESSION ' + line)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,210 @@
+'''
+Command line runner for the carbon box models.
+
+    python carbonbox.py run --model 9box --scenario A2 sine decay --solver exact --t-span 1800 2200
+    python carbonbox.py run --model models/9box.json --scenario all --solver RK45 Radau --workers 4
+    python carbonbox.py scenarios
+    python carbonbox.py report --store results --out figures
+    python carbonbox.py calibrate --obs co2.csv --units ppm --fluxes F21 F12 --t0 1800 --starts 8
+
+Every (scenario, solver) combination is run as one job, in parallel across
+worker processes, and written to a compressed NPZ store keyed by a hash of
+the model, scenario, solver settings and times, so rerunning an identical
+configuration is read back from the store instead of being recomputed.
+'''
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from Functions import box_models, get_model, get_scenario, scenario_codes, scenarios
+from Store import ResultStore, config_key, model_fingerprint
+
+SOLVERS = ['exact', 'rk4', 'RK45', 'RK23', 'DOP853', 'Radau', 'BDF', 'LSODA']
+
+
+def load_model(spec):
+    """Box model from a configuration name ('4box', '9box') or a model definition file"""
+    if spec in box_models:
+        return get_model(spec)
+    from Network import load_model as load_network
+    return load_network(spec)
+
+
+def make_config(model_spec, model, scenario, solver, t_span, n_eval, rtol, atol, steps):
+    """Configuration dict of one run, everything its result depends on; only
+    the settings the solver reads are included, so changing an unused one
+    still finds the stored result"""
+    sc = get_scenario(scenario)
+    config = {'model': model_spec, 'model_fingerprint': model_fingerprint(model),
+              'scenario': sc.name, 'scenario_knots': [sc.t_yr.tolist(), sc.e_GtC_yr.tolist()],
+              'solver': solver, 't_span': [float(t_span[0]), float(t_span[1])], 'n_eval': int(n_eval)}
+    if solver == 'rk4':
+        config['steps'] = int(steps)
+    elif solver != 'exact':
+        config.update(rtol = rtol, atol = atol)
+    return config
+
+
+def run_config(config):
+    """Runs one configuration
+
+    Returns
+    -------
+    t: 1D array
+        Output times
+    y: (n_boxes, n_t) array
+        Mass in each box
+    wall: float
+        Wall time of the solve (s)
+    """
+    from Solvers import integrate_batch, run_model, solve_linear
+
+    model = load_model(config['model'])
+    scenario = get_scenario(config['scenario'])
+    t0, tf = config['t_span']
+    t_eval = np.linspace(t0, tf, config['n_eval'])
+    start = time.perf_counter()
+    if config['solver'] == 'exact':
+        y = solve_linear(model, t_eval, scenario)
+    elif config['solver'] == 'rk4':
+        X, Y = integrate_batch(model, t0, tf, config['steps'], [scenario])
+        y = np.array([np.interp(t_eval, X, Y[0, :, i]) for i in range(model.n_boxes)])
+    else:
+        res = run_model(model, (t0, tf), scenario, method = config['solver'], t_eval = t_eval,
+                        rtol = config['rtol'], atol = config['atol'])
+        if not res.success:
+            raise RuntimeError("%s failed for scenario %s: %s" % (config['solver'], config['scenario'], res.message))
+        y = res.y
+    return t_eval, y, time.perf_counter() - start
+
+
+def run_sweep(configs, store, workers = None, forcing_box = 0):
+    """Runs the configurations that are not in the store yet, in parallel, and
+    stores their results
+
+    Returns
+    -------
+    rows: list of dicts
+        Per configuration: key, path, whether it came from the store, wall time
+        and the final mass of the forcing (atmosphere) box, row forcing_box of y
+    """
+    keys = [config_key(c) for c in configs]
+    # one job per distinct key, repeated configurations (e.g. '--scenario 1 A2') share it
+    first = {}
+    for ii, key in enumerate(keys):
+        first.setdefault(key, ii)
+    todo = [ii for key, ii in first.items() if key not in store]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers > 1 and len(todo) > 1:
+        with ProcessPoolExecutor(max_workers = min(workers, len(todo))) as pool:
+            results = dict(zip(todo, pool.map(run_config, [configs[ii] for ii in todo])))
+    else:
+        results = {ii: run_config(configs[ii]) for ii in todo}
+
+    rows = []
+    for ii, (config, key) in enumerate(zip(configs, keys)):
+        if ii in results:
+            t, y, wall = results[ii]
+            path = store.put(key, config, t = t, y = y)
+        elif first[key] in results: # a repeat of a configuration solved above
+            t, y, wall, path = *results[first[key]][:2], 0., store.path(key)
+        else:
+            stored = store.get(key)
+            t, y, wall, path = stored['t'], stored['y'], 0., store.path(key)
+        rows.append({'scenario': config['scenario'], 'solver': config['solver'], 'key': key[:12],
+                     'cached': ii not in results, 'wall_s': wall, 'final_atm_Gt': float(y[forcing_box, -1]), 'path': path})
+    return rows
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = 'carbonbox', description = 'Carbon cycle box model runner')
+    sub = parser.add_subparsers(dest = 'command', required = True)
+
+    run = sub.add_parser('run', help = 'run (or read back) a sweep of scenarios and solvers')
+    run.add_argument('--model', default = '9box', help = "'4box', '9box' or a model definition file (default 9box)")
+    run.add_argument('--scenario', nargs = '+', default = ['A2'],
+                     help = "scenario names or MassFlux codes, or 'all' (default A2)")
+    run.add_argument('--solver', nargs = '+', default = ['exact'], choices = SOLVERS, help = 'default exact')
+    run.add_argument('--t-span', nargs = 2, type = float, default = [1800., 2200.], metavar = ('START', 'END'))
+    run.add_argument('--n-eval', type = int, default = 401, help = 'output times (default 401)')
+    run.add_argument('--rtol', type = float, default = 1e-6)
+    run.add_argument('--atol', type = float, default = 1e-6)
+    run.add_argument('--steps', type = int, default = 8000, help = 'rk4 intervals (default 8000)')
+    run.add_argument('--workers', type = int, default = None, help = 'worker processes (default CPU count)')
+    run.add_argument('--store', default = 'results', help = 'result store directory (default results)')
+
+    sub.add_parser('scenarios', help = 'list the emission scenarios')
+
+    rep = sub.add_parser('report', help = 'draw figures of every run in a result store')
+    rep.add_argument('--store', default = 'results', help = 'result store directory (default results)')
+    rep.add_argument('--out', default = 'figures', help = 'figure directory (default figures)')
+    rep.add_argument('--format', default = 'png', help = 'image format (default png)')
+    rep.add_argument('--boxes', nargs = '+', default = ['atmosphere', 'surface water'])
+    rep.add_argument('--max-points', type = int, default = 2000, help = 'points per line after decimation')
+    rep.add_argument('--workers', type = int, default = None, help = 'worker processes (default CPU count)')
+
+    cal = sub.add_parser('calibrate', help = 'fit fluxes to an observed series of one box (default the atmosphere)')
+    cal.add_argument('--model', default = '9box', help = "'4box', '9box' or a model definition file (default 9box)")
+    cal.add_argument('--obs', required = True, help = 'CSV file of year, value rows')
+    cal.add_argument('--columns', nargs = 2, default = ['0', '1'], metavar = ('YEAR', 'VALUE'),
+                     help = 'column indices or header names (default 0 1)')
+    cal.add_argument('--units', default = 'GtC', choices = ['GtC', 'ppm'])
+    cal.add_argument('--fluxes', nargs = '+', required = True, help = "fluxes to fit, e.g. F21 F12")
+    cal.add_argument('--scenario', default = 'A2')
+    cal.add_argument('--sigma', type = float, default = 1., help = 'observation uncertainty in GtC (default 1)')
+    cal.add_argument('--t0', type = float, default = None, help = 'year of the steady state (default first observation)')
+    cal.add_argument('--starts', type = int, default = 1, help = 'number of multi-start fits (default 1)')
+    cal.add_argument('--prior-sd', type = float, default = None, help = 'log standard deviation of a prior on the fluxes')
+    cal.add_argument('--workers', type = int, default = None, help = 'worker processes (default CPU count)')
+    cal.add_argument('--seed', type = int, default = None)
+
+    args = parser.parse_args(argv)
+    if args.command == 'scenarios':
+        codes = {name: code for code, name in scenario_codes.items()}
+        for name in scenarios:
+            print('%-12s code %s' % (name, codes.get(name, '-')))
+        return 0
+    if args.command == 'report':
+        from Report import store_report
+
+        paths = store_report(args.store, args.out, args.format, args.boxes, args.workers, max_points = args.max_points)
+        print('%d figures written to %s' % (len(paths), args.out))
+        return 0
+    if args.command == 'calibrate':
+        from Calibrate import calibrate, read_observations
+
+        cols = [int(c) if c.isdigit() else c for c in args.columns]
+        try:
+            t_obs, obs = read_observations(args.obs, cols[0], cols[1], units = args.units)
+        except ValueError as err: # empty file, unknown column, ...
+            cal.error(str(err))
+        model = load_model(args.model)
+        scenario = int(args.scenario) if args.scenario.isdigit() else args.scenario
+        res = calibrate(model, t_obs, obs, args.fluxes, scenario, sigma = args.sigma, t0 = args.t0,
+                        n_starts = args.starts, prior_sd = args.prior_sd, n_workers = args.workers, seed = args.seed)
+        print('%-8s %12s %12s %8s %8s' % ('flux', 'initial', 'fitted', 'factor', 'log_sd'))
+        for label, factor, sd in zip(res.labels, res.factor, res.log_sd):
+            print('%-8s %12.4g %12.4g %8.3f %8.3f' % (label, res.fluxes[label]/factor, res.fluxes[label], factor, sd))
+        print('cost %.6g (%s), best of %d starts' % (res.cost, res.message, len(res.costs)))
+        return 0 if res.success else 1
+
+    names = list(scenarios) if args.scenario == ['all'] else \
+            [int(s) if s.isdigit() else s for s in args.scenario]
+    model = load_model(args.model)
+    configs = [make_config(args.model, model, s, solver, args.t_span, args.n_eval, args.rtol, args.atol, args.steps)
+               for s in names for solver in args.solver]
+    rows = run_sweep(configs, ResultStore(args.store), args.workers, model.forcing_box)
+
+    print('%-12s %-7s %-12s %-6s %9s %13s  %s' % ('scenario', 'solver', 'key', 'cached', 'wall_s', 'final_atm_Gt', 'path'))
+    for row in rows:
+        print('%-12s %-7s %-12s %-6s %9.3g %13.2f  %s' % (row['scenario'], row['solver'], row['key'], row['cached'],
+                                                         row['wall_s'], row['final_atm_Gt'], row['path']))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
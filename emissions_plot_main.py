@@ -1,5 +1,5 @@
 import numpy as np
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 
 # CONSTANTS
 #time span in years
@@ -41,10 +41,12 @@ if __name__ == "__main__":
     #call the function emissions
     e = emissions(yr)
 
-    plt.plot(yr, e)
-    plt.xlabel('Time (years')
-    plt.ylabel('CO_2 emissions (GtC/yr)')
-    plt.title('Modified IPPC scenario A2')
+    #object oriented figure, no pyplot state to clean up afterwards
+    fig = Figure()
+    ax = fig.subplots()
+    ax.plot(yr, e)
+    ax.set_xlabel('Time (years')
+    ax.set_ylabel('CO_2 emissions (GtC/yr)')
+    ax.set_title('Modified IPPC scenario A2')
 
-    plt.savefig('IPPC_A2_emissions.pdf')
-    plt.close()
+    fig.savefig('IPPC_A2_emissions.pdf')
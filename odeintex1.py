@@ -9,6 +9,7 @@
 # Is the \best\ choice of time step always the smallet one possible?  How might you define \best\ in a practical sense?
 import numpy as np
 import matplotlib.pyplot as plt
+from Convergence import dt_sweep, euler_trajectory
 #decay constant
 Lambda = 0.75 #note: capital 'L' used because 'lambda' is a built-in python function already
 
@@ -25,27 +26,22 @@ tmax = 10
 #investigate influence of time step on solution
 dts = [1.0, 0.5, 0.1, 0.01, 0.001] #time steps to investigate
 
-fig, ax = plt.subplots(nrows = 1, ncols = 1, figsize = (4,4))
+fig, (ax, ax2) = plt.subplots(nrows = 1, ncols = 2, figsize = (8,4))
 
 for jj, dt in enumerate(dts): #jj tracks index, dt is the time step of each loop
     
-    #initialize
-    steps = int(np.round(tmax/dt))
-    y = np.empty((steps+1,))
-    t = np.empty((steps+1,))
-    y[0] = y0
-    t[0] = t0
-    
-    #march forward in time
-    for step in range(steps):
-        y[step+1] = y[step] * (1 - Lambda*dt)
-        t[step+1] = t[step] + dt  
-            
-ax.plot(t,y, label = 'dt = ' + str(dt))
+    #march forward in time: after n steps y_n = y0*(1 - Lambda*dt)**n, evaluated for all steps at once
+    t, y = euler_trajectory('decay', dt, tmax, Lambda = Lambda, y0 = y0, t0 = t0)
+    ax.plot(t,y, label = 'dt = ' + str(dt))
     
 ax.set_xlabel('Time')
 ax.set_ylabel('y')
 ax.legend()
 
-plt.show()
+#error against the analytic solution y0*exp(-Lambda*t) for many more time steps
+sweep = dt_sweep(np.logspace(-4, 0.5, 1000), 'decay', Lambda = Lambda, y0 = y0, tmax = tmax)
+ax2.loglog(sweep.dt, sweep.max_err)
+ax2.set_xlabel('dt')
+ax2.set_ylabel('max error')
 
+plt.show()
@@ -0,0 +1,29 @@
+import os
+import sys
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from Network import load_model
+from Solvers import run_model, solve_linear
+
+def test_lsoda_sparse_network():
+    # network models store k as CSR, which LSODA cannot take as a Jacobian
+    model = load_model(os.path.join(ROOT, 'models', '9box.json'))
+    assert model.is_sparse
+    t = np.linspace(1800, 2200, 41)
+    res = run_model(model, (1800, 2200), 'A2', method = 'LSODA', t_eval = t, rtol = 1e-9, atol = 1e-9)
+    assert res.success
+    assert np.allclose(res.y, solve_linear(model, t, 'A2'), rtol = 1e-6, atol = 1e-6)
+
+def test_lsoda_sparse_schedule():
+    from Schedules import ScheduledBoxModel
+    base = load_model(os.path.join(ROOT, 'models', '9box.json'))
+    model = ScheduledBoxModel(base.F_in, base.M0, {'F61': ([1850, 2000, 2100], [0., 2., 0.])})
+    assert model.is_sparse
+    t = np.linspace(1800, 2200, 41)
+    res = run_model(model, (1800, 2200), 'A2', method = 'LSODA', t_eval = t, rtol = 1e-9, atol = 1e-9)
+    ref = run_model(model, (1800, 2200), 'A2', method = 'Radau', t_eval = t, rtol = 1e-9, atol = 1e-9)
+    assert res.success
+    assert np.allclose(res.y, ref.y, rtol = 1e-6, atol = 1e-6)